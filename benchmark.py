@@ -0,0 +1,279 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Offline benchmarks for pendingchanges.py
+
+Fixture files are recorded from a live run with -record:DIR or with the
+-record:FILE parameter of pendingchanges.py. Each fixture is replayed in
+its own process, so the peak memory is measured per scenario.
+
+-record:DIR       Record fixtures of the standard scenarios to DIR: short
+                  pending chains, long histories and ORES heavy runs, and
+                  huge articles if pages are given with -page:TITLE. The
+                  parameters of each scenario are stored with the fixture.
+
+-fixture:FILE     Replay a recorded fixture. Can be given more than once.
+                  Other parameters are passed to pendingchanges.py, for
+                  example the page generator used when recording. The
+                  stored parameters of fixtures recorded with -record:DIR
+                  are used automatically.
+
+-synthetic        Run CPU benchmarks of the content and revert tests with
+                  generated huge articles and long pending chains
+
+-repeat:N         Number of runs of each scenario (default 1)
+
+-json:FILE        Write the results as JSON
+
+"""
+#
+# (C) 2017 Kimmo Virtanen, <zache.fiwiki@gmail.com>
+#
+# Distributed under the terms of the MIT license.
+#
+from __future__ import absolute_import, unicode_literals
+
+import sys
+import os
+import json
+import random
+import resource
+import time
+import multiprocessing
+
+import pywikibot
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pendingchanges
+
+
+def peak_memory():
+    """Return the peak resident memory of this process in megabytes."""
+    maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / (1024.0 * 1024)
+    return maxrss / 1024.0
+
+
+# Name and pendingchanges.py parameters of the standard scenarios
+scenarios = [
+    ('short-chains', ['-pendingchanges', '-listlimit:100']),
+    ('long-histories', ['-unreviewedpages', '-listlimit:20']),
+    ('ores-heavy', ['-pendingchanges', '-listlimit:500', '-noformerbots']),
+]
+
+
+def scenario_args(fixture):
+    """Return the stored parameters of a fixture recorded with -record:DIR."""
+    argsfile=fixture + '.args'
+    if not os.path.exists(argsfile):
+        return []
+    with open(argsfile) as f:
+        return json.load(f)
+
+
+def record_scenario(fixture, args, results):
+    if os.path.exists(fixture):
+        os.remove(fixture)
+    with open(fixture + '.args', 'w') as f:
+        json.dump(list(args), f)
+    start=time.time()
+    error=None
+    try:
+        pendingchanges.main(*(list(args) + ['-simulate', '-record:' + fixture]))
+    except Exception as e:
+        error='%s: %s' % (e.__class__.__name__, e)
+    results.put({
+        'scenario': os.path.basename(fixture),
+        'recorded': os.path.getsize(fixture) if os.path.exists(fixture) else 0,
+        'seconds': time.time() - start,
+        'error': error,
+    })
+
+
+def replay_fixture(fixture, args, results):
+    # The transport is installed here to count the requests, so the caches
+    # of real runs are disabled explicitly
+    transport=pendingchanges.RecordReplay(fixture, 'replay')
+    transport.install()
+    start=time.time()
+    error=None
+    try:
+        pendingchanges.main(*(scenario_args(fixture) + list(args)
+                              + ['-simulate', '-nostate', '-nometadata', '-noorescache']))
+    except Exception as e:
+        error='%s: %s' % (e.__class__.__name__, e)
+    elapsed=max(time.time() - start, 0.001)
+    summary=pendingchanges.metrics.summary()
+    pages=max(summary['pages'], 1)
+    results.put({
+        'scenario': os.path.basename(fixture),
+        'seconds': elapsed,
+        'pages': summary['pages'],
+        'revisions': summary['revisions'],
+        'pages_per_second': summary['pages'] / elapsed,
+        'requests': transport.requests,
+        'requests_per_page': transport.requests / float(pages),
+        'bytes': transport.bytes,
+        'peak_mb': peak_memory(),
+        'rules': summary['rules'],
+        'error': error,
+    })
+
+
+def synthetic_text(words, size, seed):
+    rnd=random.Random(seed)
+    paragraphs=[]
+    for n in range(size // 100):
+        paragraphs.append(' '.join(rnd.choice(words) for i in range(100)))
+        if n % 10 == 0:
+            paragraphs.append('[[%s|%s]] {{%s}}' % (rnd.choice(words), rnd.choice(words), rnd.choice(words)))
+    paragraphs.append('[[en:Example]]\n[[sv:Exempel]]')
+    return '\n\n'.join(paragraphs)
+
+
+class SyntheticSite(object):
+
+    """Minimal site with the siteinfo needed by TextNormalizer."""
+
+    siteinfo = {'interwikimap': [{'prefix': 'en', 'language': 'English'},
+                                 {'prefix': 'sv', 'language': 'Svenska'}]}
+
+
+def synthetic_benchmark(results, articlewords=200000, chainlength=5000):
+    rnd=random.Random(1)
+    words=['word%d' % n for n in range(20000)]
+    start=time.time()
+
+    # Huge article with a small edit in the middle
+    old=synthetic_text(words, articlewords, 2)
+    middle=len(old) // 2
+    new=old[:middle] + ' lisätty teksti ' + old[middle:]
+    normalizer=pendingchanges.TextNormalizer(SyntheticSite())
+    differ=pendingchanges.TokenDiff()
+
+    t=time.time()
+    a=normalizer.tokens(1, old, interwiki=True, cleanup=True)
+    b=normalizer.tokens(2, new, interwiki=True, cleanup=True)
+    normalize=time.time() - t
+
+    t=time.time()
+    spans=differ.spans(a, b)
+    diff=time.time() - t
+
+    t=time.time()
+    shingles=normalizer.shingles(1, old, 3, interwiki=True, cleanup=True)
+    if spans:
+        for s, e in spans[0]:
+            differ.present(b, s, e, shingles, 3)
+    shingletime=time.time() - t
+
+    # Long pending chain with reverts
+    t=time.time()
+    revisions=[]
+    sha1s=['%040x' % rnd.getrandbits(160) for n in range(chainlength // 4)]
+    for n in range(chainlength):
+        revisions.append(pendingchanges.RevisionRecord(n + 1, n, 'User%d' % (n % 50), None,
+                                                       rnd.choice(sha1s), 1000))
+    detector=pendingchanges.RevertDetector(revisions, [1])
+    revert=time.time() - t
+
+    results.put({
+        'scenario': 'synthetic',
+        'seconds': time.time() - start,
+        'article_tokens': len(b),
+        'normalize_seconds': normalize,
+        'diff_seconds': diff,
+        'shingle_seconds': shingletime,
+        'chain_revisions': chainlength,
+        'revert_seconds': revert,
+        'reverted': len(detector.reverted),
+        'peak_mb': peak_memory(),
+    })
+
+
+def run_isolated(target, args):
+    """Run the scenario in its own process and return its result."""
+    results=multiprocessing.Queue()
+    process=multiprocessing.Process(target=target, args=args + (results,))
+    process.start()
+    try:
+        result=results.get(timeout=3600)
+    except Exception:
+        result={'error': 'no result'}
+    process.join()
+    return result
+
+
+def main(*args):
+    fixtures=[]
+    recorddir=None
+    synthetic=False
+    repeat=1
+    jsonfile=None
+    passed=[]
+
+    for arg in pywikibot.handle_args(args):
+        if arg.startswith('-fixture:'):
+            fixtures.append(arg[9:])
+        elif arg.startswith('-record:'):
+            recorddir=arg[8:]
+        elif arg == '-synthetic':
+            synthetic=True
+        elif arg.startswith('-repeat:'):
+            try:
+                repeat=int(arg[8:])
+            except:
+                pywikibot.error("Unsupported repeat value")
+        elif arg.startswith('-json:'):
+            jsonfile=arg[6:]
+        else:
+            passed.append(arg)
+
+    if recorddir:
+        if not os.path.isdir(recorddir):
+            os.makedirs(recorddir)
+        recorded=list(scenarios)
+        pages=[arg for arg in passed if arg.startswith('-page:')]
+        if pages:
+            recorded.append(('huge-articles', pages))
+        others=[arg for arg in passed if not arg.startswith('-page:')]
+        for name, args in recorded:
+            fixture=os.path.join(recorddir, name + '.jsonl')
+            result=run_isolated(record_scenario, (fixture, tuple(args + others)))
+            if result.get('error'):
+                pywikibot.error(u'%s: %s' % (name, result['error']))
+            else:
+                pywikibot.output(u'%s: %d bytes recorded in %.1fs' % (fixture, result['recorded'], result['seconds']))
+        return
+
+    if not fixtures and not synthetic:
+        pywikibot.showHelp('benchmark')
+        return
+
+    results=[]
+    for n in range(repeat):
+        for fixture in fixtures:
+            results.append(run_isolated(replay_fixture, (fixture, tuple(passed))))
+        if synthetic:
+            results.append(run_isolated(synthetic_benchmark, ()))
+
+    for result in results:
+        if result.get('error'):
+            pywikibot.error(u'%s: %s' % (result.get('scenario'), result['error']))
+        if result.get('scenario') == 'synthetic':
+            pywikibot.output(u'synthetic: %(article_tokens)d tokens normalized in %(normalize_seconds).3fs, '
+                             u'diffed in %(diff_seconds).3fs, shingles %(shingle_seconds).3fs; '
+                             u'%(chain_revisions)d revisions revert tested in %(revert_seconds).3fs; '
+                             u'peak %(peak_mb).1f MB' % result)
+        elif 'pages' in result:
+            pywikibot.output(u'%(scenario)s: %(pages)d pages in %(seconds).2fs (%(pages_per_second).1f pages/s), '
+                             u'%(requests_per_page).1f requests/page, %(bytes)d bytes, '
+                             u'peak %(peak_mb).1f MB' % result)
+
+    if jsonfile:
+        with open(jsonfile, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
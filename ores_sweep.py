@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Test ORES thresholds offline against a recorded corpus
+
+The corpus is recorded with the -corpus:FILE parameter of pendingchanges.py.
+For each combination of thresholds the script reports how many revisions
+and pages would be approved and how far the latest ok revision of the
+pages moves compared to the baseline thresholds.
+
+-corpus:FILE          Corpus file. Can be given more than once.
+
+-model:NAME           ORES model to test (default goodfaith)
+
+-true_min:RANGE       Thresholds to test. RANGE is a single value or
+-true_max:RANGE       start:stop:step, for example 0.5:0.95:0.05
+-false_min:RANGE      (defaults are the thresholds of pendingchanges.py)
+-false_max:RANGE
+
+-baseline:a,b,c,d     Baseline true_min, true_max, false_min and false_max
+                      (default 0.85,1,0,0.15)
+
+-csv:FILE             Write the results as CSV
+
+"""
+#
+# (C) 2017 Kimmo Virtanen, <zache.fiwiki@gmail.com>
+#
+# Distributed under the terms of the MIT license.
+#
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import json
+import itertools
+
+import numpy as np
+
+
+# Default thresholds of pendingchanges.py
+defaults = {'true_min': 0.85, 'true_max': 1.0, 'false_min': 0.0, 'false_max': 0.15}
+
+# Largest number of settings x revisions tested at once
+chunkcells = 10 * 1000 * 1000
+
+
+class Corpus(object):
+
+    """Recorded revisions as arrays sorted by page and revision id."""
+
+    def __init__(self, filenames, model):
+        """Constructor."""
+        pagekeys={}
+        pages=[]
+        revids=[]
+        approved=[]
+        scores=[]
+        for filename in filenames:
+            with open(filename) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry=json.loads(line)
+                    key=(entry["wiki"], entry["pageid"])
+                    pages.append(pagekeys.setdefault(key, len(pagekeys)))
+                    revids.append(entry["revid"])
+                    approved.append(bool(entry["rule"]))
+                    scores.append(entry["ores"].get(model, (np.nan, np.nan)))
+
+        pages=np.array(pages, dtype=np.int64)
+        revids=np.array(revids, dtype=np.int64)
+        order=np.lexsort((revids, pages))
+        pages=pages[order]
+        revids=revids[order]
+
+        # Same revision can be recorded by several runs
+        unique=np.ones(len(order), dtype=bool)
+        unique[1:]=(pages[1:] != pages[:-1]) | (revids[1:] != revids[:-1])
+        order=order[unique]
+
+        self.pages = pages[unique]
+        self.revids = revids[unique]
+        self.approved = np.array(approved, dtype=bool)[order]
+        scores=np.array(scores, dtype=np.float64).reshape(-1, 2)[order]
+        self.true = scores[:, 0]
+        self.false = scores[:, 1]
+
+        # Position of each revision in its page
+        self.starts = np.flatnonzero(np.r_[True, self.pages[1:] != self.pages[:-1]])
+        self.lengths = np.diff(np.r_[self.starts, len(self.pages)])
+        self.positions = (np.arange(len(self.pages)) - np.repeat(self.starts, self.lengths)).astype(np.int32)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def approved_counts(self, true_min, true_max, false_min, false_max):
+        """
+        Return the number of approved revisions of each page per setting.
+
+        Revisions are approved until the first revision which is not ok,
+        as the bot reviews the latest ok revision. Thresholds are arrays
+        with one value per setting.
+
+        @return: array of shape (settings, pages)
+        """
+        # Comparisons with missing scores are false
+        with np.errstate(invalid='ignore'):
+            ok=((self.true[None, :] >= true_min[:, None])
+                & (self.true[None, :] <= true_max[:, None])
+                & (self.false[None, :] >= false_min[:, None])
+                & (self.false[None, :] <= false_max[:, None]))
+        ok|=self.approved[None, :]
+
+        # First revision of each page which is not ok
+        notok=np.where(ok, np.int32(len(self)), self.positions[None, :])
+        firstbad=np.minimum.reduceat(notok, self.starts, axis=1)
+        return np.minimum(firstbad, self.lengths[None, :])
+
+
+def parse_range(value):
+    """Return the values of start:stop:step, stop included."""
+    parts=[float(part) for part in value.split(':')]
+    if len(parts) == 1:
+        return np.array(parts)
+    start, stop, step=parts
+    return np.round(np.arange(start, stop + step / 2, step), 6)
+
+
+def sweep(corpus, grids, baseline):
+    """Return the results of all the threshold combinations."""
+    names=('true_min', 'true_max', 'false_min', 'false_max')
+    settings=np.array(list(itertools.product(*[grids[name] for name in names])), dtype=np.float64)
+    base=corpus.approved_counts(*[np.array([value]) for value in baseline])[0]
+
+    results=[]
+    chunk=max(1, chunkcells // max(len(corpus), 1))
+    for i in range(0, len(settings), chunk):
+        part=settings[i:i + chunk]
+        counts=corpus.approved_counts(*[part[:, n] for n in range(4)])
+        moved=counts - base[None, :]
+        for n, setting in enumerate(part):
+            result=dict(zip(names, setting))
+            result.update({
+                'revisions': int(counts[n].sum()),
+                'pages': int((counts[n] > 0).sum()),
+                'complete_pages': int((counts[n] == corpus.lengths).sum()),
+                'pages_moved': int((moved[n] != 0).sum()),
+                'revisions_moved': int(moved[n].sum()),
+            })
+            results.append(result)
+    return results
+
+
+def main(*args):
+    filenames=[]
+    model='goodfaith'
+    grids={name:np.array([value]) for name, value in defaults.items()}
+    baseline=[defaults['true_min'], defaults['true_max'], defaults['false_min'], defaults['false_max']]
+    csvfile=None
+
+    for arg in args or sys.argv[1:]:
+        name, _, value=arg[1:].partition(':')
+        if name == 'corpus':
+            filenames.append(value)
+        elif name == 'model':
+            model=value
+        elif name in grids:
+            try:
+                grids[name]=parse_range(value)
+            except ValueError:
+                print("Unsupported %s value" % name, file=sys.stderr)
+                return
+        elif name == 'baseline':
+            try:
+                baseline=[float(part) for part in value.split(',')]
+            except ValueError:
+                baseline=[]
+            if len(baseline) != 4:
+                print("Unsupported baseline value", file=sys.stderr)
+                return
+        elif name == 'csv':
+            csvfile=value
+        else:
+            print("Unknown parameter %s" % arg, file=sys.stderr)
+            return
+
+    if not filenames:
+        print(__doc__)
+        return
+
+    corpus=Corpus(filenames, model)
+    print("%d revisions of %d pages, %d approved by other rules"
+          % (len(corpus), len(corpus.starts), corpus.approved.sum()))
+    results=sweep(corpus, grids, baseline)
+
+    columns=('true_min', 'true_max', 'false_min', 'false_max', 'revisions', 'pages',
+             'complete_pages', 'pages_moved', 'revisions_moved')
+    print('\t'.join(columns))
+    for result in results:
+        print('\t'.join('%g' % result[column] for column in columns))
+
+    if csvfile:
+        with open(csvfile, 'w') as f:
+            f.write(','.join(columns) + '\n')
+            for result in results:
+                f.write(','.join('%g' % result[column] for column in columns) + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -9,15 +9,106 @@ These command line parameters can be used to specify which pages to work on:
 
 -pendingchanges   Work on all NS0 articles where changes are pending
 
+-stream           Run continuously and work on NS0 articles as they are
+                  edited. Edits are read from recent changes.
+
+-stream:SOURCE    Read edits from EventStreams style JSON lines. SOURCE is
+                  a file, - for standard input or tcp:host:port
+
+-debounce:n       Wait until a page has not been edited for n seconds
+                  before checking it in stream mode (default 30)
+
 -unreviewedpages  Work on all NS0 articles which have never been reviewed using 
                   Flagged revision
 
+-listlimit:N      Number of pages listed per request with -pendingchanges
+                  and -unreviewedpages (default 500)
+
+-readahead:N      Number of pages buffered between listing, prefetching
+                  and checking. 0 runs the stages one after another.
+                  (default 100)
+
+-window:N         Fetch and check the history of a page N revisions at a
+                  time and stop fetching at the first revision which is not
+                  ok. Useful with -unreviewedpages. Reverts made after
+                  the window are not found. (default 0, the whole
+                  history is fetched at once)
+
+-serverdiff       Use diffs made by the server in the content tests instead
+                  of downloading the full texts of the revisions. Only the
+                  latest text of the page is downloaded, unless an edit
+                  adds less than three words in a place.
+
 -noformerbots     Do not autoreview former bots
 
 -noores           Do not use scores from ORES for approval
 
+-toollabs         Ask Tool Labs if a revision was reverted when it is not
+                  found from the page history
+
 -daylimit:N       Do not review page if the version that is being reviewed is older than N days
 
+-workers:N        Process N pages in parallel
+
+-apirate:n        Make at most n requests per second to the API of each wiki
+                  and to ORES and Tool Labs
+
+-sites:LIST       Work on several wikis in one process. LIST is a comma
+                  separated list of lang:family pairs, for example
+                  fi:wikipedia,sv:wikipedia. Pages of all the wikis are
+                  checked by the same workers.
+
+-reviewrate:n     Make at most n reviews per minute
+
+-maxlag:N         Maxlag value sent with the reviews (default 5)
+
+-stats:FILE       Write request latencies, rule timings and page rates as
+                  JSON at exit
+
+-promfile:FILE    Write the same statistics as a Prometheus textfile every
+                  minute and at exit
+
+-profile:FILE     Write cProfile statistics of page checking
+
+-record:FILE      Record the responses of API, ORES and Tool Labs requests
+                  to a fixture file. Decisions of earlier runs, the site
+                  metadata snapshot and the ORES and user caches are not
+                  used, so all the requests are recorded.
+
+-replay:FILE      Serve requests from a recorded fixture file instead of
+                  the network. Caches are not used as with -record.
+
+-corpus:FILE      Append the rule outcomes and ORES scores of all pending
+                  revisions to FILE for ores_sweep.py. Revisions after the
+                  first one which is not ok are tested too.
+
+-textcache:N      Keep at most N megabytes of revision texts in memory
+
+-patrolwindow:N   Load the patrol log of the last N days at once. Older
+                  revisions are checked page by page.
+
+-usercache        Store the looked up user rights to disk for an hour
+
+-state:FILE       SQLite file where decisions are stored between runs.
+                  Unchanged pages which were not ok in the last run are
+                  skipped and revisions approved earlier are not checked
+                  again, except by the content tests which depend on the
+                  latest version and by rules whose settings have
+                  changed. Simulated runs store decisions only when FILE
+                  is given.
+
+-nostate          Do not use decisions of earlier runs
+
+-metadata:FILE    File where ORES models, former bots, interwiki prefixes and
+                  flagged revisions configuration of the sites are stored
+                  between runs. Old items are refreshed in the background.
+
+-nometadata       Fetch the site metadata again in every run
+
+-noorescache      Do not store ORES scores to disk between runs
+
+-recheckhours:n   Check unchanged pages again after n hours (default 24)
+
 -ores_goodfaith_true_min:n     Minimum value needed for ORES goodfaith true value
 -ores_goodfaith_true_max:n     Maximum value needed for ORES goodfaith true value
 -ores_goodfaith_false_min:n    Minimum value needed for ORES goodfaith false value
@@ -43,131 +134,1991 @@ Example:
 from __future__ import absolute_import, unicode_literals
 
 import sys
+import os
 import re
 import json
+import collections
+import random
+import socket
+import sqlite3
+import threading
+import bisect
+import difflib
+import cProfile
+import pstats
+from collections import OrderedDict
+from contextlib import contextmanager
+import requests
 import pywikibot
 from pywikibot import User
 from pywikibot import config
 from pywikibot import i18n
-from pywikibot import pagegenerators
 from pywikibot.data import api
 from pywikibot.comms import http
 from urllib import quote
-import dateutil.parser
 import datetime
 import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+class HelpReplacements(dict):
+
+    """Help text replacements which import pagegenerators only for -help."""
+
+    def items(self):
+        from pywikibot import pagegenerators
+        return [('&params;', pagegenerators.parameterHelp)]
+
+
 # This is required for the text that is shown when you run this script
 # with the parameter -help.
-docuReplacements = {
-    '&params;': pagegenerators.parameterHelp,
-}
+docuReplacements = HelpReplacements()
+
+class RateLimiter(object):
+
+    """Limit the rate of requests made by all threads together."""
+
+    def __init__(self, rate=None):
+        """
+        Constructor.
+
+        @param rate: requests per second or None for no limit
+        """
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now=time.time()
+            delay=self._next - now
+            self._next=max(now, self._next) + 1.0 / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SiteRateLimiters(object):
+
+    """Rate limiters of the wikis.
+
+    API requests to each wiki are limited separately. Requests without a
+    site, to ORES and Tool Labs, share one limiter.
+    """
+
+    def __init__(self, rate=None):
+        """
+        Constructor.
+
+        @param rate: requests per second of each limiter or None for no limit
+        """
+        self.rate = rate
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, site=None):
+        key='%s:%s' % (site.family, site.lang) if site is not None else None
+        with self._lock:
+            if key not in self._limiters:
+                self._limiters[key]=RateLimiter(self.rate)
+            return self._limiters[key]
+
+    def wait(self, site=None):
+        self.get(site).wait()
+
+
+# Shared by all API, ORES and Tool Labs requests made by this script
+apilimiter = SiteRateLimiters()
+
+
+class Metrics(object):
+
+    """Performance counters of the bot.
+
+    Latency histograms are kept per external endpoint and time, hits and
+    misses per approval rule.
+    """
+
+    buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        """Constructor."""
+        self.started = time.time()
+        self.pages = 0
+        self.revisions = 0
+        self._latency = {}
+        self._rules = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, seconds):
+        with self._lock:
+            if endpoint not in self._latency:
+                self._latency[endpoint] = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+            histogram=self._latency[endpoint]
+            for n, limit in enumerate(self.buckets):
+                if seconds <= limit:
+                    histogram['buckets'][n]+=1
+            histogram['count']+=1
+            histogram['sum']+=seconds
+
+    @contextmanager
+    def timed(self, endpoint):
+        start=time.time()
+        try:
+            yield
+        finally:
+            self.observe(endpoint, time.time() - start)
+
+    def rule(self, name, seconds, hit):
+        with self._lock:
+            if name not in self._rules:
+                self._rules[name] = {'seconds': 0.0, 'hits': 0, 'misses': 0}
+            stats=self._rules[name]
+            stats['seconds']+=seconds
+            stats['hits' if hit else 'misses']+=1
+
+    def count(self, pages=0, revisions=0):
+        with self._lock:
+            self.pages+=pages
+            self.revisions+=revisions
+
+    def summary(self):
+        with self._lock:
+            elapsed=max(time.time() - self.started, 0.001)
+            return {
+                'elapsed': elapsed,
+                'pages': self.pages,
+                'revisions': self.revisions,
+                'pages_per_second': self.pages / elapsed,
+                'revisions_per_second': self.revisions / elapsed,
+                'buckets': list(self.buckets),
+                'endpoints': {name: {'buckets': list(h['buckets']), 'count': h['count'], 'sum': h['sum']}
+                              for name, h in self._latency.items()},
+                'rules': {name: dict(stats) for name, stats in self._rules.items()},
+            }
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def write_prometheus(self, filename):
+        """Write the counters in Prometheus text format for node_exporter."""
+        summary=self.summary()
+        lines=['# TYPE pendingchanges_pages_total counter',
+               'pendingchanges_pages_total %d' % summary['pages'],
+               '# TYPE pendingchanges_revisions_total counter',
+               'pendingchanges_revisions_total %d' % summary['revisions'],
+               '# TYPE pendingchanges_request_seconds histogram']
+        for name, histogram in sorted(summary['endpoints'].items()):
+            for limit, count in zip(self.buckets, histogram['buckets']):
+                lines.append('pendingchanges_request_seconds_bucket{endpoint="%s",le="%s"} %d' % (name, limit, count))
+            lines.append('pendingchanges_request_seconds_bucket{endpoint="%s",le="+Inf"} %d' % (name, histogram['count']))
+            lines.append('pendingchanges_request_seconds_sum{endpoint="%s"} %f' % (name, histogram['sum']))
+            lines.append('pendingchanges_request_seconds_count{endpoint="%s"} %d' % (name, histogram['count']))
+        lines.append('# TYPE pendingchanges_rule_seconds_total counter')
+        lines.append('# TYPE pendingchanges_rule_checks_total counter')
+        for name, stats in sorted(summary['rules'].items()):
+            lines.append('pendingchanges_rule_seconds_total{rule="%s"} %f' % (name, stats['seconds']))
+            lines.append('pendingchanges_rule_checks_total{rule="%s",result="hit"} %d' % (name, stats['hits']))
+            lines.append('pendingchanges_rule_checks_total{rule="%s",result="miss"} %d' % (name, stats['misses']))
+
+        tmpname=filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmpname, filename)
+
+
+# Collected from all threads
+metrics = Metrics()
+
+
+def backoff_delay(attempt, base=1.0, maximum=120.0):
+    """Return jittered exponential delay in seconds for a retry."""
+    delay=min(maximum, base * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.5)
+
+
+class HttpResult(object):
+
+    """Result of a request made with HttpClient.
+
+    Failed requests have the reason in error instead of raising an
+    exception.
+    """
+
+    __slots__ = ('url', 'status', 'data', 'error')
+
+    def __init__(self, url, status=None, data=None, error=None):
+        """Constructor."""
+        self.url = url
+        self.status = status
+        self.data = data
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class HttpClient(object):
+
+    """Pooled HTTP client for the JSON endpoints outside the MediaWiki API.
+
+    Connections are kept alive and pooled per host and responses are
+    compressed. Each endpoint has its own timeout and number of retries.
+    Concurrent requests of the same URL share a single fetch.
+    """
+
+    endpoints = {
+        'ores': {'timeout': 60, 'retries': 4},
+        'toollabs': {'timeout': 30, 'retries': 2},
+        'default': {'timeout': 30, 'retries': 2},
+    }
+
+    def __init__(self, poolsize=10):
+        """Constructor."""
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolsize, pool_maxsize=poolsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'User-Agent': http.user_agent(),
+                                     'Accept-Encoding': 'gzip'})
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get_json(self, endpoint, url):
+        """Fetch JSON from the url and return a HttpResult."""
+        with self._lock:
+            call=self._inflight.get(url)
+            owner=call is None
+            if owner:
+                call={'event': threading.Event(), 'result': None}
+                self._inflight[url]=call
+
+        if not owner:
+            call['event'].wait()
+            return call['result']
+
+        result=HttpResult(url, error='Request was not made')
+        try:
+            result=self._fetch(endpoint, url)
+        finally:
+            with self._lock:
+                del self._inflight[url]
+            call['result']=result
+            call['event'].set()
+        return result
+
+    def _fetch(self, endpoint, url):
+        policy=self.endpoints.get(endpoint, self.endpoints['default'])
+        status=None
+        error=None
+        for attempt in range(policy['retries'] + 1):
+            if attempt:
+                delay=backoff_delay(attempt - 1)
+                pywikibot.warning(u'Reading %s failed (%s), retrying in %.1f s' % (url, error, delay))
+                time.sleep(delay)
+
+            apilimiter.wait()
+            try:
+                with metrics.timed(endpoint):
+                    response=self.session.get(url, timeout=policy['timeout'])
+            except requests.RequestException as e:
+                error=str(e)
+                continue
+
+            status=response.status_code
+            if status >= 500 or status == 429:
+                error='HTTP %d' % status
+                continue
+            if status != 200:
+                return HttpResult(url, status, error='HTTP %d' % status)
+            try:
+                return HttpResult(url, status, response.json())
+            except ValueError as e:
+                return HttpResult(url, status, error='Invalid JSON: %s' % e)
+
+        return HttpResult(url, status, error=error)
+
+
+# Shared by all ORES and Tool Labs requests
+httpclient = HttpClient()
+
+
+class ReplayMissing(Exception):
+
+    """Response of a request was not found from the fixture file."""
+
+
+class RecordReplay(object):
+
+    """Record API and HTTP responses to a fixture file or serve them from it.
+
+    The shim replaces api.Request.submit and HttpClient._fetch, so the bot
+    can be run offline against responses recorded from a live run.
+    Requests are matched by their parameters; responses to repeated
+    requests are served in the recorded order. Parameters which depend on
+    the time of the run are ignored.
+    """
+
+    ignored = ('token', 'maxlag', 'lestart', 'leend', 'rcstart', 'requestid', 'curtimestamp')
+
+    def __init__(self, filename, mode='replay'):
+        """
+        Constructor.
+
+        @param mode: 'record' or 'replay'
+        """
+        self.filename = filename
+        self.mode = mode
+        self.requests = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._responses = {}
+        if mode == 'replay':
+            with open(filename) as f:
+                for line in f:
+                    if line.strip():
+                        entry=json.loads(line)
+                        self._responses.setdefault(entry["key"], collections.deque()).append(entry)
+        else:
+            self._file = open(filename, 'a')
+
+    @classmethod
+    def api_key(cls, request):
+        params=sorted((key, '|'.join('%s' % value for value in values))
+                      for key, values in request._params.items()
+                      if key not in cls.ignored)
+        return 'api:%s:%s' % (request.site, json.dumps(params))
+
+    def handle(self, key, call):
+        """Return the response of the call for the key, recorded or replayed."""
+        if self.mode == 'replay':
+            with self._lock:
+                responses=self._responses.get(key)
+                if not responses:
+                    raise ReplayMissing(key)
+                entry=responses[0]
+                # The last response is reused for any extra requests
+                if len(responses) > 1:
+                    responses.popleft()
+                self.requests+=1
+                self.bytes+=entry["bytes"]
+            return entry
+
+        entry=call()
+        entry["key"]=key
+        line=json.dumps(entry)
+        entry["bytes"]=len(line)
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            self.requests+=1
+            self.bytes+=entry["bytes"]
+        return entry
+
+    def install(self):
+        transport=self
+        original_submit=api.Request.submit
+        original_fetch=HttpClient._fetch
+
+        def submit(request):
+            def call():
+                try:
+                    return {'data': original_submit(request)}
+                except api.APIError as e:
+                    return {'error': [e.code, e.info]}
+            entry=transport.handle(transport.api_key(request), call)
+            if "error" in entry:
+                raise api.APIError(*entry["error"])
+            return entry["data"]
+
+        def fetch(client, endpoint, url):
+            def call():
+                result=original_fetch(client, endpoint, url)
+                return {'status': result.status, 'data': result.data, 'httperror': result.error}
+            entry=transport.handle('http:%s' % url, call)
+            return HttpResult(url, entry["status"], entry["data"], entry["httperror"])
+
+        api.Request.submit=submit
+        HttpClient._fetch=fetch
+
+
+class ReviewQueue(object):
+
+    """Submit reviews in a background thread.
+
+    The edit token is reused until the server rejects it. Reviews are
+    limited to a number of edits per minute, sent with maxlag and transient
+    failures are retried with jittered exponential backoff.
+    """
+
+    # Error codes which are worth retrying
+    transient = ('maxlag', 'readonly', 'internal_api_error_DBQueryError',
+                 'internal_api_error_DBConnectionError', 'ratelimited')
+
+    def __init__(self, site, editsperminute=None, maxlag=5, retries=5):
+        """Constructor."""
+        self.site = site
+        self.maxlag = maxlag
+        self.retries = retries
+        self.limiter = RateLimiter(editsperminute / 60.0 if editsperminute else None)
+        self._token = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, title, rev_id, comment):
+        self._queue.put((title, rev_id, comment))
+
+    def close(self):
+        """Wait until all queued reviews are done."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _worker(self):
+        while True:
+            item=self._queue.get()
+            if item is None:
+                break
+            title, rev_id, comment=item
+            try:
+                if self.review(rev_id, comment):
+                    pywikibot.output(u'Reviewed revision: %d of %s with comment: "%s"' % (rev_id, title, comment))
+            except Exception as e:
+                pywikibot.error(u'Reviewing revision %d of %s failed' % (rev_id, title))
+                pywikibot.exception(e)
+
+    def token(self):
+        if self._token is None:
+            self._token=self.site.tokens['edit']
+        return self._token
+
+    def review(self, rev_id, comment):
+        for attempt in range(self.retries):
+            self.limiter.wait()
+            apilimiter.wait(self.site)
+            parameters={'action':'review', 'revid':rev_id, 'flag_accuracy': 1, 'token': self.token(),
+                        'comment': comment, 'maxlag': self.maxlag}
+            try:
+                req = api.Request(site=self.site, parameters=parameters)
+                with metrics.timed('api:review'):
+                    req.submit()
+                return True
+            except api.APIError as e:
+                if e.code == 'badtoken':
+                    # Token expired, get a new one and try again at once
+                    self._token=None
+                    self.site.tokens.load_tokens(['edit'])
+                    continue
+                if e.code not in self.transient:
+                    pywikibot.error("There was an API error when reviewing the edit %d: %s" % (rev_id, e))
+                    return False
+                error=e
+            except (api.TimeoutError, pywikibot.Server504Error, IOError) as e:
+                error=e
+
+            delay=backoff_delay(attempt)
+            pywikibot.warning(u'Reviewing revision %d failed (%s), retrying in %.1f s' % (rev_id, error, delay))
+            time.sleep(delay)
+
+        pywikibot.error(u'Giving up reviewing revision %d' % rev_id)
+        return False
+
+
+class PageContext(object):
+
+    """State of a single page while it is processed.
+
+    Output is collected to the context and written at once so that the log
+    of a page is not mixed with other pages processed at the same time.
+    """
+
+    _outputlock = threading.Lock()
+
+    def __init__(self, page):
+        """Constructor."""
+        self.page = page
+        self.site = page.site
+        self.state = None
+        self.flaggedinfo = None
+        self.pending_since = None
+        self.latest_revid = None
+        self.history = None
+        self.revertdetector = None
+        self.patrolledrevs = None
+        # Set when the content test has approved a revision of the page
+        self.contentapproved = False
+        self.diffs = None
+        self._lines = []
+
+    def output(self, text):
+        self._lines.append(text)
+
+    def flush(self):
+        with self._outputlock:
+            for text in self._lines:
+                pywikibot.output(text)
+        self._lines = []
+
+
+class OresScoreCache(object):
+
+    """Bounded LRU cache of ORES scores keyed by revision id.
+
+    Scores of a given revision and model never change, so the cache can be
+    stored to disk and reused between runs.
+    """
+
+    def __init__(self, filename=None, maxsize=100000):
+        """Constructor."""
+        self.filename = filename
+        self.maxsize = maxsize
+        self._scores = OrderedDict()
+        self._changed = False
+        if filename:
+            self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            pywikibot.warning(u'Reading ORES cache %s failed' % self.filename)
+            return
+        for rev_id, score in data:
+            self._scores[str(rev_id)]=score
+        self._trim()
+
+    def save(self):
+        if not self.filename or not self._changed:
+            return
+        data=[[rev_id, score] for rev_id, score in self._scores.items()]
+        tmpname=self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmpname, self.filename)
+        self._changed = False
+
+    def _trim(self):
+        while len(self._scores) > self.maxsize:
+            self._scores.popitem(last=False)
+
+    def get(self, rev_id, models):
+        key=str(rev_id)
+        score=self._scores.get(key)
+        if score is None:
+            return None
+        for model in models:
+            if model not in score:
+                return None
+        # Move to the end so that the least recently used items are dropped first
+        del self._scores[key]
+        self._scores[key]=score
+        return score
+
+    def add(self, rev_id, score):
+        key=str(rev_id)
+        old=self._scores.pop(key, {})
+        old.update(score)
+        self._scores[key]=old
+        self._changed = True
+        self._trim()
+
+
+class OresScorer(object):
+
+    """Batched ORES client shared by all pages.
+
+    Revision ids of the page being checked and of the upcoming pages are
+    queued by the robot and sent to ORES in full-size chunks when a score
+    which is not in the cache is needed.
+    """
+
+    batchsize = 50
+
+    def __init__(self, site, cache, models=('damaging', 'reverted', 'goodfaith')):
+        """Constructor."""
+        self.site = site
+        self.cache = cache
+        self.models = list(models)
+        self._pending = OrderedDict()
+        self._lock = threading.RLock()
+
+    def queue(self, rev_ids):
+        with self._lock:
+            for rev_id in rev_ids:
+                if self.cache.get(rev_id, self.models) is None:
+                    self._pending[int(rev_id)]=True
+
+    def fetch(self, rev_ids):
+        url=(u'https://ores.wikimedia.org/scores/%s?models=%s&revids=' % (self.site.dbName(), '|'.join(self.models)))
+        url=url + "|".join(str(key)  for key in rev_ids)
+
+        result=httpclient.get_json('ores', url)
+        if not result.ok:
+           # Revisions without scores are not approved by ORES
+           pywikibot.error(u'Reading %s failed: %s' % (url, result.error))
+           return
+
+        for rev_id, score in result.data.items():
+           # Do not cache errors, they can be temporary
+           score={model:value for model, value in score.items()
+                  if isinstance(value, dict) and "error" not in value}
+           if score:
+              self.cache.add(rev_id, score)
+
+    def flush(self):
+        rev_ids=list(self._pending)
+        self._pending.clear()
+        for i in range(0, len(rev_ids), self.batchsize):
+           self.fetch(rev_ids[i:i + self.batchsize])
+
+    def scheduled(self, rev_id):
+        """Test if the score is cached or fetched with the next batch."""
+        with self._lock:
+           return (int(rev_id) in self._pending
+                   or self.cache.get(rev_id, self.models) is not None)
+
+    def get(self, rev_id):
+        # Pages processed in parallel wait for the same batch
+        with self._lock:
+           score=self.cache.get(rev_id, self.models)
+           if score is None:
+              self._pending[int(rev_id)]=True
+              self.flush()
+              score=self.cache.get(rev_id, self.models)
+           return score
+
+    def save(self):
+        with self._lock:
+           self.cache.save()
+
+
+class UserRightsResolver(object):
+
+    """Groups and rights of the users who made the pending revisions.
+
+    Users are looked up only when they are seen, in batches of 50 names.
+    Results are cached for ttl seconds and optionally stored to disk.
+    Rights are derived from the explicit groups of the user only, so
+    rights of implicit groups such as autoconfirmed are not included.
+    """
+
+    batchsize = 50
+    version = 2
+
+    def __init__(self, site, ttl=3600, filename=None):
+        """Constructor."""
+        self.site = site
+        self.ttl = ttl
+        self.filename = filename
+        self._users = {}
+        self._grouprights = None
+        self._lock = threading.RLock()
+        if filename:
+            self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            pywikibot.warning(u'Reading user cache %s failed' % self.filename)
+            return
+        # Caches of other versions can have the rights of implicit groups
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            return
+        now=time.time()
+        for name, (expires, groups, rights) in data["users"].items():
+            if expires > now:
+                self._users[name]=(expires, frozenset(groups), frozenset(rights))
+
+    def save(self):
+        if not self.filename:
+            return
+        with self._lock:
+            users={name:[expires, list(groups), list(rights)]
+                   for name, (expires, groups, rights) in self._users.items()}
+        data={'version': self.version, 'users': users}
+        tmpname=self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmpname, self.filename)
+
+    def grouprights(self):
+        """Return the rights of each user group of the site."""
+        with self._lock:
+            if self._grouprights is None:
+                parameters={'action':'query', 'meta':'siteinfo', 'siprop':'usergroups'}
+                grouprights={}
+                for data in query_continue(self.site, parameters):
+                    for group in data["query"].get("usergroups", []):
+                        grouprights[group["name"]]=frozenset(group.get("rights", []))
+                self._grouprights=grouprights
+            return self._grouprights
+
+    def prefetch(self, names):
+        """Look up the users which are not in the cache."""
+        now=time.time()
+        with self._lock:
+            missing=[]
+            for name in set(names):
+                if not name:
+                    continue
+                if name not in self._users or self._users[name][0] < now:
+                    missing.append(name)
+
+            for i in range(0, len(missing), self.batchsize):
+                chunk=missing[i:i + self.batchsize]
+                parameters={'action':'query', 'list':'users', 'usprop':'groups|implicitgroups',
+                            'ususers':'|'.join(chunk)}
+                expires=time.time() + self.ttl
+                grouprights=self.grouprights()
+                for data in query_continue(self.site, parameters):
+                    for user in data["query"]["users"]:
+                        # IP addresses are returned as invalid users
+                        groups=(frozenset(user.get("groups", []))
+                                - frozenset(user.get("implicitgroups", [])))
+                        rights=frozenset()
+                        for group in groups:
+                            rights|=grouprights.get(group, frozenset())
+                        self._users[user["name"]]=(expires, groups, rights)
+                # Names which were not returned have no rights
+                for name in chunk:
+                    if name not in self._users:
+                        self._users[name]=(expires, frozenset(), frozenset())
+
+    def get(self, name):
+        """Return the groups and rights of the user."""
+        if not name:
+            return frozenset(), frozenset()
+        self.prefetch([name])
+        with self._lock:
+            expires, groups, rights = self._users[name]
+        return groups, rights
+
+    def is_bot(self, name):
+        return 'bot' in self.get(name)[0]
+
+    def is_autoreviewed(self, name):
+        rights=self.get(name)[1]
+        return 'autoreview' in rights or 'autopatrol' in rights
+
+
+class SiteMetadata(object):
+
+    """Snapshot of site level metadata stored on disk between runs.
+
+    Items are stored per site with the time they were fetched. An item
+    older than its TTL is used as it is and refreshed in a background
+    thread, so a warm snapshot does not delay the start of a run. Missing
+    items are fetched at once. Snapshots of other versions are ignored.
+    """
+
+    version = 1
+
+    # Seconds after which the items are refreshed
+    ttls = {
+        'ores': 24 * 3600,
+        'formerbots': 24 * 3600,
+        'interwiki': 7 * 24 * 3600,
+        'flaggedrevs': 7 * 24 * 3600,
+    }
+
+    def __init__(self, filename=None):
+        """
+        Constructor.
+
+        @param filename: snapshot file or None to keep the items in memory
+        """
+        self.filename = filename
+        self._items = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        if filename:
+            self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            pywikibot.warning(u'Reading site metadata %s failed' % self.filename)
+            return
+        if data.get("version") == self.version:
+            self._items=data.get("sites", {})
+
+    def save(self):
+        if not self.filename:
+            return
+        # Background refreshes can save at the same time
+        with self._lock:
+            tmpname=self.filename + '.tmp'
+            with open(tmpname, 'w') as f:
+                json.dump({'version': self.version, 'sites': self._items}, f)
+            os.rename(tmpname, self.filename)
+
+    def get(self, site, name, fetch):
+        """
+        Return the item, fetching it if it is missing.
+
+        @param fetch: function returning the value for the site or None if
+            fetching failed. Failures are not stored.
+        """
+        key=DecisionStore.sitekey(site)
+        with self._lock:
+            item=self._items.get(key, {}).get(name)
+            stale=item is not None and time.time() - item[0] > self.ttls.get(name, 24 * 3600)
+            if stale and (key, name) not in self._refreshing:
+                self._refreshing.add((key, name))
+                thread=threading.Thread(target=self.refresh, args=(site, name, fetch))
+                thread.daemon=True
+                thread.start()
+        if item is not None:
+            return item[1]
+        return self.refresh(site, name, fetch)
+
+    def refresh(self, site, name, fetch):
+        key=DecisionStore.sitekey(site)
+        try:
+            value=fetch(site)
+        finally:
+            with self._lock:
+                self._refreshing.discard((key, name))
+        if value is None:
+            return None
+        with self._lock:
+            self._items.setdefault(key, {})[name]=[time.time(), value]
+        self.save()
+        return value
+
+
+class DecisionStore(object):
+
+    """Decisions of earlier runs stored in a SQLite database.
+
+    For each page the latest revision id at the time of the check, the
+    revision which blocked the review and the approved revisions with their
+    rules and the configuration of the rules are stored.
+    """
+
+    def __init__(self, filename):
+        """Constructor."""
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                site TEXT, pageid INTEGER, latest_revid INTEGER,
+                blocking_revid INTEGER, checked REAL,
+                PRIMARY KEY (site, pageid));
+            CREATE TABLE IF NOT EXISTS approvals (
+                site TEXT, pageid INTEGER, revid INTEGER, rule TEXT, config TEXT,
+                PRIMARY KEY (site, revid));
+            CREATE INDEX IF NOT EXISTS approvals_page ON approvals (site, pageid);
+        """)
+
+    @staticmethod
+    def sitekey(site):
+        return '%s:%s' % (site.family, site.lang)
+
+    def get_page(self, site, pageid):
+        """Return latest revid, blocking revid and check time of the page."""
+        with self._lock:
+            cursor=self._db.execute(
+                'SELECT latest_revid, blocking_revid, checked FROM pages WHERE site=? AND pageid=?',
+                (self.sitekey(site), pageid))
+            return cursor.fetchone()
+
+    def get_approved(self, site, pageid):
+        """Return (rule, config) of the approved revisions keyed by revid."""
+        with self._lock:
+            cursor=self._db.execute(
+                'SELECT revid, rule, config FROM approvals WHERE site=? AND pageid=?',
+                (self.sitekey(site), pageid))
+            return {revid:(rule, config) for revid, rule, config in cursor}
+
+    def record(self, site, pageid, latest_revid, blocking_revid, approved):
+        """
+        Store the decisions of a page.
+
+        @param approved: (revid, rule, config) of the approved revisions
+        """
+        sitekey=self.sitekey(site)
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                    (sitekey, pageid, latest_revid, blocking_revid, time.time()))
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO approvals VALUES (?, ?, ?, ?, ?)',
+                    [(sitekey, pageid, revid, rule, config) for revid, rule, config in approved])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class PatrolLogIndex(object):
+
+    """Patrolled revision ids of the whole wiki in a time window.
+
+    The patrol log is loaded once for the window and later only the entries
+    which are newer than the already loaded ones are fetched. A revision is
+    always patrolled after it was saved, so the index knows about all
+    revisions saved inside the window.
+    """
+
+    def __init__(self, site, maxdays=30, refresh=300):
+        """
+        Constructor.
+
+        @param maxdays: do not load log entries older than this
+        @param refresh: seconds between fetches of newer entries
+        """
+        self.site = site
+        self.maxdays = maxdays
+        self.refresh = refresh
+        self.start = None
+        self._revids = set()
+        self._loaded = None
+        self._lastrefresh = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, rev_id):
+        return rev_id in self._revids
+
+    def covers(self, timestamp):
+        return self.start is not None and timestamp >= self.start
+
+    def load(self, start, end=None):
+        """Load log entries from start to end, newest first."""
+        apilimiter.wait(self.site)
+        with metrics.timed('api:logevents'):
+            log_gen=self.site.logevents(logtype="patrol", start=end, end=start)
+            for entry in log_gen:
+                self._revids.add(entry.current_id)
+
+    def ensure(self, since):
+        """Make sure that the index covers the time from since to now."""
+        oldest=pywikibot.Timestamp.utcnow() - datetime.timedelta(days=self.maxdays)
+        since=max(since, oldest)
+
+        with self._lock:
+            now=pywikibot.Timestamp.utcnow()
+            if self.start is None:
+                self.load(since)
+                self.start=since
+                self._loaded=now
+                self._lastrefresh=time.time()
+                return
+
+            if since < self.start:
+                self.load(since, self.start)
+                self.start=since
+
+            if time.time() - self._lastrefresh > self.refresh:
+                # A little overlap so that no entries are lost between fetches
+                self.load(self._loaded - datetime.timedelta(minutes=1))
+                self._loaded=now
+                self._lastrefresh=time.time()
+
+
+class RevisionRecord(object):
+
+    """Compact metadata of a single revision."""
+
+    __slots__ = ('revid', 'parentid', 'user', 'timestamp', 'sha1', 'size', 'tags')
+
+    def __init__(self, revid, parentid, user, timestamp, sha1=None, size=0, tags=()):
+        """Constructor."""
+        self.revid = revid
+        self.parentid = parentid
+        self.user = user
+        self.timestamp = timestamp
+        self.sha1 = sha1
+        self.size = size
+        self.tags = tags
+
+    @classmethod
+    def fromapi(cls, rev):
+        """Create a record from a revision dict returned by the API."""
+        # User name is missing when it is hidden
+        return cls(int(rev["revid"]), int(rev.get("parentid", 0)), rev.get("user", ""),
+                   pywikibot.Timestamp.fromISOformat(rev["timestamp"]),
+                   rev.get("sha1"), int(rev.get("size", 0)), tuple(rev.get("tags", ())))
+
+
+class RevisionHistory(object):
+
+    """Revisions of a page from the reviewed version to the latest one.
+
+    The history is fetched once per page and shared by all the rules.
+    """
+
+    def __init__(self, revisions, stable_revid=0):
+        """Constructor."""
+        self.revisions = revisions
+        self.stable_revid = stable_revid
+        self.pending = [rev for rev in revisions if rev.revid > stable_revid]
+
+    def __iter__(self):
+        return iter(self.revisions)
+
+    def __len__(self):
+        return len(self.revisions)
+
+
+class ApprovalSummary(object):
+
+    """Approved revisions of a page as needed for the review comment.
+
+    Revision ids and user names are kept only until they no longer fit in
+    a comment, so the memory use does not grow with the history.
+    """
+
+    maxlength = 150
+
+    def __init__(self, keepapproved=True):
+        """
+        Constructor.
+
+        @param keepapproved: keep the (revid, rule) pairs until they are
+            stored with pop_approved
+        """
+        self.keepapproved = keepapproved
+        self.count = 0
+        self.revids = set()
+        self.users = set()
+        self.rules = set()
+        self.moreusers = False
+        # (revid, rule) pairs which are not stored yet
+        self.approved = []
+        self._revlength = 0
+        self._userlength = 0
+
+    def add(self, rev, rule):
+        self.count+=1
+        self.rules.add(rule)
+        if self.keepapproved:
+            self.approved.append((rev.revid, rule))
+        if self._revlength <= self.maxlength:
+            self.revids.add(rev.revid)
+            self._revlength+=len(str(rev.revid)) + 2
+        if rev.user and rev.user not in self.users:
+            if self._userlength <= self.maxlength:
+                self.users.add(rev.user)
+                self._userlength+=len(rev.user) + 2
+            else:
+                self.moreusers=True
+
+    def copy(self):
+        """Return a copy of the summary."""
+        summary=ApprovalSummary(self.keepapproved)
+        summary.__dict__.update(self.__dict__)
+        summary.revids=set(self.revids)
+        summary.users=set(self.users)
+        summary.rules=set(self.rules)
+        summary.approved=list(self.approved)
+        return summary
+
+    def pop_approved(self):
+        """Return the approvals added since the last call."""
+        approved=self.approved
+        self.approved=[]
+        return approved
+
+
+class CorpusWriter(object):
+
+    """Write the rule outcomes and ORES scores of revisions as JSON lines.
+
+    The corpus is used by ores_sweep.py for testing ORES thresholds
+    offline.
+    """
+
+    def __init__(self, filename):
+        """Constructor."""
+        self.filename = filename
+        self._file = open(filename, 'a')
+        self._lock = threading.Lock()
+
+    def write(self, site, pageid, rev, rule, scores):
+        """
+        Write a revision.
+
+        @param rule: the first rule other than ORES which approves the
+            revision or an empty string
+        @param scores: ORES scores of the revision or None
+        """
+        probabilities={}
+        for model, score in (scores or {}).items():
+            if "probability" in score:
+                probabilities[model]=[float(score["probability"]["true"]),
+                                      float(score["probability"]["false"])]
+        line=json.dumps({'wiki': site.dbName(), 'pageid': pageid, 'revid': rev.revid,
+                         'timestamp': rev.timestamp.isoformat() if rev.timestamp else None,
+                         'rule': rule, 'ores': probabilities})
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class RevisionTextCache(object):
+
+    """Revision texts keyed by revision id.
+
+    The cache is bounded by the total size of the texts in bytes and the
+    least recently used texts are dropped first. Missing texts are fetched
+    with multi-revid queries, so a text is downloaded once and used both as
+    the text of a revision and as the parent text of the next one.
+    """
+
+    batchsize = 50
+
+    def __init__(self, maxbytes=64 * 1024 * 1024):
+        """Constructor."""
+        self.maxbytes = maxbytes
+        self._texts = OrderedDict()
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def __contains__(self, rev_id):
+        return rev_id in self._texts
+
+    def get(self, rev_id):
+        with self._lock:
+            if rev_id not in self._texts:
+                return None
+            text, size = self._texts.pop(rev_id)
+            self._texts[rev_id]=(text, size)
+            return text
+
+    def add(self, rev_id, text, size):
+        with self._lock:
+            if rev_id in self._texts:
+                self._size-=self._texts.pop(rev_id)[1]
+            self._texts[rev_id]=(text, size)
+            self._size+=size
+            while self._size > self.maxbytes and len(self._texts) > 1:
+                self._size-=self._texts.popitem(last=False)[1][1]
+
+    def prefetch(self, site, rev_ids):
+        """Fetch the texts of revisions which are not in the cache."""
+        missing=[]
+        for rev_id in rev_ids:
+            if rev_id and rev_id not in self._texts and rev_id not in missing:
+                missing.append(rev_id)
+
+        for i in range(0, len(missing), self.batchsize):
+            chunk=missing[i:i + self.batchsize]
+            parameters={'action':'query', 'prop':'revisions', 'rvprop':'ids|content|size',
+                        'revids':'|'.join(str(rev_id) for rev_id in chunk)}
+            for data in query_continue(site, parameters):
+                pages=data["query"]["pages"]
+                if isinstance(pages, dict):
+                    pages=pages.values()
+                for pageinfo in pages:
+                    for rev in pageinfo.get("revisions", []):
+                        # Hidden texts are cached as None
+                        text=rev.get("*", rev.get("content"))
+                        self.add(int(rev["revid"]), text, int(rev.get("size", 0)))
+
+    def fetch(self, site, rev_id):
+        if rev_id not in self._texts:
+            self.prefetch(site, [rev_id])
+        return self.get(rev_id)
+
+
+class DiffHunks(object):
+
+    """Deleted and added lines of a diff rendered by MediaWiki.
+
+    Moved paragraphs are both deleted and added, so the order of the lines
+    is lost. Such diffs are marked as moved.
+    """
+
+    __slots__ = ('deleted', 'added', 'moved')
+
+    cell = re.compile(r'<td class="diff-(deletedline|addedline)[^"]*"[^>]*>(.*?)</td>', re.S)
+    tag = re.compile(r'<[^>]+>')
+
+    def __init__(self, deleted, added, moved=False):
+        """Constructor."""
+        self.deleted = deleted
+        self.added = added
+        self.moved = moved
+
+    @classmethod
+    def fromhtml(cls, html):
+        deleted=[]
+        added=[]
+        for kind, content in cls.cell.findall(html):
+            line=unescape(cls.tag.sub('', content))
+            if kind == 'deletedline':
+                deleted.append(line)
+            else:
+                added.append(line)
+        return cls(deleted, added, 'mw-diff-movedpara' in html)
+
+
+def fetch_diffs(site, revs, batchsize=50):
+    """
+    Return the diffs of the revisions to their parents keyed by revid.
+
+    Diffs are fetched in batches with rvdiffto. Diffs which the server
+    has not cached are fetched one by one with action=compare. Revisions
+    without a diff are missing from the result.
+    """
+    result={}
+    parents={rev.revid: rev.parentid for rev in revs if rev.parentid}
+    revids=list(parents)
+    for i in range(0, len(revids), batchsize):
+        parameters={'action':'query', 'prop':'revisions', 'rvprop':'ids', 'rvdiffto':'prev',
+                    'revids':'|'.join(str(rev_id) for rev_id in revids[i:i + batchsize])}
+        for data in query_continue(site, parameters):
+            pages=data["query"]["pages"]
+            if isinstance(pages, dict):
+                pages=pages.values()
+            for pageinfo in pages:
+                for rev in pageinfo.get("revisions", []):
+                    diff=rev.get("diff", {})
+                    html=diff.get("*", diff.get("body"))
+                    if html is not None:
+                        result[int(rev["revid"])]=DiffHunks.fromhtml(html)
+
+    for rev_id in revids:
+        if rev_id in result:
+            continue
+        parameters={'action':'compare', 'fromrev':parents[rev_id], 'torev':rev_id}
+        apilimiter.wait(site)
+        req = api.Request(site=site, parameters=parameters)
+        try:
+            with metrics.timed('api:compare'):
+                data = req.submit()
+        except api.APIError as e:
+            pywikibot.warning(u'Comparing revision %d failed: %s' % (rev_id, e))
+            continue
+        html=data.get("compare", {}).get("*", data.get("compare", {}).get("body"))
+        if html is not None:
+            result[rev_id]=DiffHunks.fromhtml(html)
+    return result
+
+
+class TextNormalizer(object):
+
+    """Normalize revision texts for the content tests.
+
+    Patterns are compiled once and the normalized texts and word sets are
+    memoized by revision id, so the latest text of a page is tokenized once
+    instead of once per revision.
+    """
+
+    wikicleanup = re.compile(r"[\[\]\{\}\|.,:;'\"<>()\-–*]+")
+    whitespace = re.compile(r"\s+")
+
+    def __init__(self, site, maxitems=64, prefixes=None):
+        """
+        Constructor.
+
+        @param prefixes: language link prefixes or None to read them from
+            the siteinfo
+        """
+        self.site = site
+        self.maxitems = maxitems
+        self.prefixes = prefixes
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._interwiki = None
+
+    @staticmethod
+    def get_prefixes(site):
+        """Return the language link prefixes of the site."""
+        interwikimap=site.siteinfo.get('interwikimap', [])
+        return [iw['prefix'] for iw in interwikimap if 'language' in iw]
+
+    @property
+    def interwiki(self):
+        """Pattern matching the language links of the site."""
+        if self._interwiki is None:
+            prefixes=self.prefixes
+            if prefixes is None:
+                prefixes=self.get_prefixes(self.site)
+            prefixes=list(prefixes)
+            if prefixes:
+                prefixes.sort(key=len, reverse=True)
+                iwlist="|".join(re.escape(prefix.lower()) for prefix in prefixes)
+                self._interwiki=re.compile(r"\[\[(" + iwlist + r"):[^\]\n]*?\]\]")
+            else:
+                self._interwiki=re.compile(r"(?!)")
+        return self._interwiki
+
+    def _memoize(self, key, func):
+        with self._lock:
+            if key in self._memo:
+                value=self._memo.pop(key)
+                self._memo[key]=value
+                return value
+        value=func()
+        with self._lock:
+            self._memo[key]=value
+            while len(self._memo) > self.maxitems:
+                self._memo.popitem(last=False)
+        return value
+
+    def text(self, rev_id, text, interwiki=False):
+        """Return lowercased text optionally without language links."""
+        def normalize():
+            if interwiki:
+                return self.interwiki.sub("", self.text(rev_id, text)).strip()
+            return text.lower().strip()
+        return self._memoize((rev_id, 'text', interwiki), normalize)
+
+    def tokens(self, rev_id, text, interwiki=False, cleanup=False):
+        """Return the words of the normalized text in order."""
+        def split():
+            normalized=self.text(rev_id, text, interwiki)
+            if cleanup:
+                # Remove special characters
+                normalized=self.wikicleanup.sub(" ", normalized).strip()
+            return tuple(self.whitespace.split(normalized))
+        return self._memoize((rev_id, 'tokens', interwiki, cleanup), split)
+
+    def words(self, rev_id, text, interwiki=False, cleanup=False):
+        """Return the set of words of the normalized text."""
+        def split():
+            return frozenset(self.tokens(rev_id, text, interwiki, cleanup))
+        return self._memoize((rev_id, 'words', interwiki, cleanup), split)
+
+    def shingles(self, rev_id, text, size, interwiki=False, cleanup=False):
+        """Return the set of word sequences of given size in the text."""
+        def split():
+            tokens=self.tokens(rev_id, text, interwiki, cleanup)
+            if len(tokens) < size:
+                return frozenset([tokens])
+            return frozenset(tokens[i:i + size] for i in range(len(tokens) - size + 1))
+        return self._memoize((rev_id, 'shingles', size, interwiki, cleanup), split)
+
+
+class TokenDiff(object):
+
+    """Find the inserted and deleted spans between two token sequences.
+
+    Common prefix and suffix are removed and the rest is split recursively
+    using tokens which are unique in both sequences as anchors (patience
+    diff). Small ranges without anchors are diffed with difflib. The cost is
+    limited by the number of tokens and by time; if the limits are exceeded
+    no result is returned.
+    """
+
+    def __init__(self, maxtokens=500000, timeout=2.0, maxquadratic=250000):
+        """Constructor."""
+        self.maxtokens = maxtokens
+        self.timeout = timeout
+        self.maxquadratic = maxquadratic
+
+    def anchors(self, a, alo, ahi, b, blo, bhi):
+        """Return the longest increasing run of unique common tokens."""
+        positions={}
+        for i in range(alo, ahi):
+            entry=positions.setdefault(a[i], [0, i, 0, 0])
+            entry[0]+=1
+        for j in range(blo, bhi):
+            entry=positions.get(b[j])
+            if entry is not None:
+                entry[2]+=1
+                entry[3]=j
+        pairs=sorted((entry[1], entry[3]) for entry in positions.values()
+                     if entry[0] == 1 and entry[2] == 1)
+
+        # Patience sorting of the b positions
+        tails=[]
+        tailindex=[]
+        previous=[None] * len(pairs)
+        for n, (i, j) in enumerate(pairs):
+            k=bisect.bisect_left(tails, j)
+            if k > 0:
+                previous[n]=tailindex[k - 1]
+            if k == len(tails):
+                tails.append(j)
+                tailindex.append(n)
+            else:
+                tails[k]=j
+                tailindex[k]=n
+
+        result=[]
+        n=tailindex[-1] if tailindex else None
+        while n is not None:
+            result.append(pairs[n])
+            n=previous[n]
+        result.reverse()
+        return result
+
+    def spans(self, a, b):
+        """
+        Return inserted spans of b and deleted spans of a.
+
+        @return: tuple of lists of (start, end) pairs or None
+        """
+        if len(a) + len(b) > self.maxtokens:
+            return None
+        deadline=time.time() + self.timeout
+        inserted=[]
+        deleted=[]
+        stack=[(0, len(a), 0, len(b))]
+
+        while stack:
+            if time.time() > deadline:
+                return None
+            alo, ahi, blo, bhi=stack.pop()
+
+            while alo < ahi and blo < bhi and a[alo] == b[blo]:
+                alo+=1
+                blo+=1
+            while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+                ahi-=1
+                bhi-=1
+
+            if alo == ahi or blo == bhi:
+                if blo < bhi:
+                    inserted.append((blo, bhi))
+                if alo < ahi:
+                    deleted.append((alo, ahi))
+                continue
+
+            anchors=self.anchors(a, alo, ahi, b, blo, bhi)
+            if anchors:
+                for i, j in anchors:
+                    stack.append((alo, i, blo, j))
+                    alo, blo=i + 1, j + 1
+                stack.append((alo, ahi, blo, bhi))
+            elif (ahi - alo) * (bhi - blo) <= self.maxquadratic:
+                matcher=difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+                for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                    if tag in ('replace', 'insert'):
+                        inserted.append((blo + j1, blo + j2))
+                    if tag in ('replace', 'delete'):
+                        deleted.append((alo + i1, alo + i2))
+            else:
+                # Too big to diff, everything is changed
+                inserted.append((blo, bhi))
+                deleted.append((alo, ahi))
+
+        inserted.sort()
+        deleted.sort()
+        return inserted, deleted
+
+    @staticmethod
+    def present(tokens, start, end, shingles, size, everywhere=False):
+        """
+        Test if the span tokens[start:end] is found from the shingles.
+
+        Word sequences overlapping the span include its context, so that
+        also short spans are tested at their original place. Sequences
+        must contain at least two tokens of the span, as a single token at
+        the edge of the span can be aligned to either side of it.
+
+        @param everywhere: require all overlapping sequences to be found
+        """
+        overlap=min(2, end - start)
+        lo=max(0, start - size + overlap)
+        hi=min(len(tokens), end + size - overlap)
+        if hi - lo < size:
+            return tokens[lo:hi] in shingles
+        for i in range(lo, hi - size + 1):
+            found=tokens[i:i + size] in shingles
+            if found and not everywhere:
+                return True
+            if not found and everywhere:
+                return False
+        return everywhere
+
+
+class RevertDetector(object):
+
+    """Find identity reverts from the SHA1 hashes of a page history.
+
+    A revision is reverted if a later revision restores the page to a state
+    which it had before the revision. A revision is a revert to reviewed
+    version if its content is identical to a reviewed revision.
+    """
+
+    def __init__(self, revisions=(), reviewed_revids=()):
+        """
+        Constructor.
+
+        @param revisions: iterable of RevisionRecord objects, oldest first.
+            Only revid and sha1 are used and the records are not kept.
+        @param reviewed_revids: ids of the reviewed revisions in revisions
+        """
+        self.reverted=set()
+        self.reverts=set()
+        self.unknown=set()
+
+        self._reviewed_revids=set(int(rev_id) for rev_id in reviewed_revids)
+        self._reviewed_sha1s=set()
+        self._firstseen={}
+        self._revids=[]
+        # Start of a run of reverted revisions keyed by its last revision
+        self._runstart={}
+        self.extend(revisions)
+
+    def extend(self, revisions):
+        """
+        Add the next revisions of the history, oldest first.
+
+        Reverts are found as the revisions are added, so a revision which
+        is reverted only by a revision which is not added yet is not
+        found.
+        """
+        for rev in revisions:
+           n=len(self._revids)
+           rev_id=rev.revid
+           sha1=rev.sha1
+           self._revids.append(rev_id)
+
+           if not sha1:
+              self.unknown.add(rev_id)
+              continue
+
+           if rev_id in self._reviewed_revids:
+              self._reviewed_sha1s.add(sha1)
+           elif sha1 in self._reviewed_sha1s:
+              self.reverts.add(rev_id)
+
+           if sha1 in self._firstseen:
+              # Everything between the earlier identical state and this
+              # revision was reverted
+              start=self._firstseen[sha1] + 1
+              if start < n:
+                 self._mark(start, n)
+           else:
+              self._firstseen[sha1]=n
+
+    def _mark(self, start, end):
+        """Mark the revisions from start to end - 1 as reverted."""
+        n=end - 1
+        while n >= start:
+           if n in self._runstart:
+              # Skip a run which is already reverted
+              n=self._runstart[n] - 1
+           else:
+              self.reverted.add(self._revids[n])
+              n-=1
+        self._runstart[end - 1]=n + 1
+
+    def test(self, rev_id, action):
+        if action == "reverted":
+           return rev_id in self.reverted
+        elif action == "revert":
+           return rev_id in self.reverts
+        return False
+
+
+class ApprovalRule(object):
+
+    """Rule which can approve a pending revision.
+
+    The test is called with the page context and the revision. Rules
+    declare the data they depend on and an estimate of their cost in
+    seconds, which is used until the real cost has been measured.
+    """
+
+    def __init__(self, name, test, requires=(), cost=0.001, reasons=None, remote=False, tentative=()):
+        """
+        Constructor.
+
+        @param requires: names of the data the test needs
+        @param reasons: values returned by the test which approve the
+            revision. By default any true value approves with the name of
+            the rule as the reason.
+        @param remote: rule is a fallback to an external service and is
+            tested only after all the local rules
+        @param tentative: approve reasons which can be rolled back later.
+            Other local rules are still tested for a stable reason.
+        """
+        self.name = name
+        self.test = test
+        self.requires = frozenset(requires)
+        self.cost = cost
+        self.reasons = reasons
+        self.remote = remote
+        self.tentative = frozenset(tentative)
+
+    def check(self, ctx, rev):
+        """Return the approve reason or an empty string."""
+        result=self.test(ctx, rev)
+        if self.reasons is not None:
+            return result if result in self.reasons else ""
+        return self.name if result else ""
+
+
+class RulePlanner(object):
+
+    """Evaluate approval rules in the order of their expected cost.
+
+    Remote fallback rules are always tested last. Otherwise rules whose
+    data is already available are tested first. Rules are then ordered by
+    their measured cost per approval, so cheap rules which often approve
+    come first. Evaluation stops at the first rule which approves the
+    revision. After a tentative approval the other local rules are
+    tested, so the result does not depend on the order.
+    """
+
+    def __init__(self, rules):
+        """Constructor."""
+        self.rules = list(rules)
+        # seconds, hits and checks per rule
+        self._stats = {rule.name: [0.0, 0, 0] for rule in self.rules}
+        self._lock = threading.Lock()
+
+    def rank(self, rule):
+        """Return the expected cost of the rule per approval."""
+        seconds, hits, checks=self._stats[rule.name]
+        cost=(seconds + rule.cost) / (checks + 1)
+        hitrate=(hits + 1.0) / (checks + 2)
+        return cost / hitrate
+
+    def order(self, available):
+        """Return the rules in evaluation order."""
+        with self._lock:
+            return sorted(self.rules,
+                          key=lambda rule: (rule.remote, not rule.requires <= available, self.rank(rule)))
+
+    def evaluate(self, ctx, rev, available):
+        """
+        Return the approve reason of the revision or an empty string.
+
+        @param available: names of the data which is already fetched
+        """
+        tentative=""
+        for rule in self.order(available):
+            if tentative and (rule.remote or rule.tentative):
+                continue
+            start=time.time()
+            reason=rule.check(ctx, rev)
+            seconds=time.time() - start
+            with self._lock:
+                stats=self._stats[rule.name]
+                stats[0]+=seconds
+                stats[1]+=1 if reason else 0
+                stats[2]+=1
+            metrics.rule(reason if reason and rule.reasons else rule.name, seconds, reason != "")
+            if reason in rule.tentative:
+                tentative=reason
+            elif reason:
+                return reason
+        return tentative
+
+
+class SiteState(object):
+
+    """Caches, indexes and the review queue of one wiki."""
+
+    def __init__(self, site, textcachesize=64 * 1024 * 1024, patrolwindow=30, usercache=0,
+                 reviewrate=None, maxlag=5, interwiki=None, orescache=1):
+        """
+        Constructor.
+
+        @param interwiki: language link prefixes of the site or None to read
+            them from the siteinfo
+        @param orescache: store ORES scores to disk between runs
+        """
+        self.site = site
+        self.formerbotusers = {}
+        self.oressiteinfo = {}
+
+        cachefile=None
+        if orescache:
+            cachefile=config.datafilepath('pendingchanges-ores-%s.json' % site.dbName())
+        self.oresscorer=OresScorer(site, OresScoreCache(cachefile))
+        self.textcache=RevisionTextCache(textcachesize)
+        self.normalizer=TextNormalizer(site, prefixes=interwiki)
+        self.patrollog=PatrolLogIndex(site, patrolwindow)
+
+        usercachefile=None
+        if usercache:
+            usercachefile=config.datafilepath('pendingchanges-users-%s.json' % site.dbName())
+        self.userrights=UserRightsResolver(site, filename=usercachefile)
+        self.reviews=ReviewQueue(site, reviewrate, maxlag)
+
+    def save(self):
+        self.oresscorer.save()
+        self.userrights.save()
+
 
 class PendingChangesRobot(object):
 
-    def __init__(self, generator, oresconfig=None, daylimit=None, useformerbots=1):
+    # Number of upcoming pages whose histories are loaded ahead
+    lookahead = 10
+
+    # Number of next content test candidates whose texts are fetched
+    # with the current one after a content approval
+    textlookahead = 10
+
+    # Content test results which approve the revision
+    contentreasons = ("nochange", "interwiki", "notinlatest")
+
+    # Approvals of earlier runs which do not depend on the latest version
+    # of the page. Content tests are run again and the other approvals
+    # only if the configuration of the rule is unchanged.
+    reusablerules = frozenset(("bot", "autoreview", "formerbot", "patrolled", "reverted", "revert", "ores"))
+
+    def __init__(self, generator, oresconfig=None, daylimit=None, useformerbots=1, usetoollabs=0, workers=1,
+                 textcachesize=64 * 1024 * 1024, patrolwindow=30, usercache=0,
+                 statefile=None, recheckhours=24, reviewrate=None, maxlag=5,
+                 statsfile=None, promfile=None, profilefile=None, window=0, corpusfile=None,
+                 metadatafile=None, serverdiff=0, orescache=1, savestate=1):
         """Constructor."""
         self.generator = generator
         self.simulateMode = pywikibot.config.simulate
-        self.autoreviewedusers = {}
-        self.botusers = {}
-        self.formerbotusers = {}
-        self.oressiteinfo=self.get_ores_siteinfo()
         self.oresconfig = oresconfig
         self.daylimit = daylimit
         self.useformerbots=useformerbots
+        self.usetoollabs=usetoollabs
+        self.workers=workers
+        self._loginlock=threading.Lock()
+        self.tokendiff=TokenDiff()
+
+        # Per wiki state is created when the first page of the wiki is seen
+        self.textcachesize=textcachesize
+        self.patrolwindow=patrolwindow
+        self.usercache=usercache
+        self.orescache=orescache
+        self.reviewrate=reviewrate
+        self.maxlag=maxlag
+        self._states={}
+        self._stateslock=threading.Lock()
+
+        self.decisions=DecisionStore(statefile) if statefile else None
+        self.savestate=savestate
+        self.metadata=SiteMetadata(metadatafile)
+        self.recheckhours=recheckhours
+        self.window=window
+        self.serverdiff=serverdiff
+        self.corpus=CorpusWriter(corpusfile) if corpusfile else None
+        self._lastsave=time.time()
+
+        self.statsfile=statsfile
+        self.promfile=promfile
+        self.profilefile=profilefile
+        self._lastprom=time.time()
+        self._profiles=threading.local()
+        self._allprofiles=[]
+        self.planner=RulePlanner(self.get_rules())
+
+    def get_state(self, site):
+        """Return the state of the wiki, creating it on first use."""
+        key=DecisionStore.sitekey(site)
+        with self._stateslock:
+            state=self._states.get(key)
+            if state is None:
+                pywikibot.output(u'Family: %s ; Lang %s' % (site.family, site.lang))
+                metadata=self.metadata
+                if not metadata.get(site, 'flaggedrevs', self.get_flaggedrevs_config):
+                    pywikibot.warning(u'Flagged revisions configuration of %s was not found' % site)
+                state=SiteState(site, self.textcachesize, self.patrolwindow, self.usercache,
+                                self.reviewrate, self.maxlag,
+                                metadata.get(site, 'interwiki', TextNormalizer.get_prefixes),
+                                self.orescache)
+                state.oressiteinfo=metadata.get(site, 'ores', self.get_ores_siteinfo) or {}
+                if self.useformerbots:
+                    formerbots=metadata.get(site, 'formerbots', self.get_formerbotusers) or []
+                    state.formerbotusers=set(formerbots)
+                self._states[key]=state
+            return state
+
+    def get_formerbotusers(self, site):
+        url=('http://tools.wmflabs.org/fiwiki-tools/pendingchanges/?action=formerbots&family=%s&lang=%s' % (site.family, site.lang))
+
+        result=httpclient.get_json('toollabs', url)
+        if not result.ok or "formerbots" not in result.data:
+            pywikibot.error(u'Reading %s failed: %s' % (url, result.error))
+            return None
+        userlist=list(result.data["formerbots"])
 
-        # Page cache
-        self._patrolledrevs=None
-        self._oresrevs=None
-
-    def reset_pagecache(self):
-        self._patrolledrevs=None
-        self._oresrevs=None
-
-
-    def get_autoreviewedusers(self):
-        users_gen = api.ListGenerator(listaction="allusers", site=pywikibot.Site(), aurights='autoreview|autopatrol')
-        userlist = {ul['name']:ul for ul in users_gen}
-        return userlist
-
-    def get_botusers(self):
-        site=pywikibot.Site()
-        userlist = {ul['name']:ul for ul in site.botusers()}
         return userlist
 
-    def get_formerbotusers(self):
-        site=pywikibot.Site()
-        url=('http://tools.wmflabs.org/fiwiki-tools/pendingchanges/?action=formerbots&family=wikipedia&lang=%s' % site.lang)
-
+    def get_flaggedrevs_config(self, site):
+        apilimiter.wait(site)
+        req = api.Request(site=site, parameters={'action':'flagconfig'})
         try:
-            file=http.fetch(url)
-        except:
-            pywikibot.error(u'Reading %s failed' %  url)
-        data = json.loads(file.decode("utf-8"))
-        userlist={name:1 for name in data["formerbots"]}
-        
-        return userlist
+            with metrics.timed('api:flagconfig'):
+                data = req.submit()
+        except api.APIError as e:
+            pywikibot.error(u'Reading flagged revisions configuration failed: %s' % e)
+            return None
+        return data.get("flagconfig")
 
     def test_reverted(self, page, rev_id, action):
-        site=pywikibot.Site()
-        url=('http://tools.wmflabs.org/fiwiki-tools/pendingchanges/?lang=%s&action=%s&family=wikipedia&rev_id=%d' % (site.lang, action, rev_id))
-        try:
-            file=http.fetch(url)
-        except:
-            pywikibot.error(u'Reading %s failed' %  url)
+        site=page.site
+        url=('http://tools.wmflabs.org/fiwiki-tools/pendingchanges/?lang=%s&action=%s&family=%s&rev_id=%d' % (site.lang, action, site.family, rev_id))
+        result=httpclient.get_json('toollabs', url)
+        if not result.ok or action not in result.data:
+            pywikibot.error(u'Reading %s failed: %s' % (url, result.error))
+            return 0
 
-        data = json.loads(file.decode("utf-8"))        
+        data=result.data
         if (str(rev_id) in data[action] 
            and  data[action][str(rev_id)] == True):
            return 1
 
         return 0
 
-    def get_ores_siteinfo(self):
-        site=pywikibot.Site()
-        sitename=('%swiki' % site.lang)
+    def test_revert(self, revertdetector, rev_id, action):
+        if revertdetector.test(rev_id, action):
+           return 1
+        return 0
+
+    def history_revisions(self, page, flaggedinfo, rvprop, rvlimit='max'):
+        """
+        Yield the revisions from the reviewed version to the latest one.
+
+        Revisions are yielded as lists of at most rvlimit revision dicts.
+        The next list is fetched only when the previous one is consumed.
+        """
+        parameters={'action':'query', 'prop':'revisions', 'pageids':page.pageid,
+                    'rvprop':rvprop, 'rvdir':'newer', 'rvlimit':rvlimit}
+
+        flagged=flaggedinfo.get("flagged", {})
+        stable_revid=int(flagged.get("stable_revid", 0))
+        if stable_revid:
+           parameters["rvstartid"]=stable_revid
+        elif "pending_since" in flagged:
+           parameters["rvstart"]=flagged["pending_since"]
+
+        for data in query_continue(page.site, parameters):
+           pages=data["query"]["pages"]
+           if isinstance(pages, dict):
+              pages=pages.values()
+           for pageinfo in pages:
+              yield pageinfo.get("revisions", [])
+
+    def load_history(self, page, flaggedinfo):
+        """Return revisions from the reviewed version to the latest one."""
+        stable_revid=int(flaggedinfo.get("flagged", {}).get("stable_revid", 0))
+        revisions=[]
+        for revs in self.history_revisions(page, flaggedinfo, 'ids|timestamp|user|sha1|size|tags'):
+           revisions.extend(RevisionRecord.fromapi(rev) for rev in revs)
+        return RevisionHistory(revisions, stable_revid)
+
+    def queue_ores(self, state, revisions):
+        """Queue the revisions which are not approved by user rights for ORES."""
+        state.userrights.prefetch([rev.user for rev in revisions])
+        # Queued revisions are sent only when a score is needed
+        if not self.ores_enabled(state):
+           return
+        revlist=[]
+        for rev in revisions:
+           if not (state.userrights.is_bot(rev.user) or state.userrights.is_autoreviewed(rev.user)):
+              revlist.append(rev.revid)
+        state.oresscorer.queue(revlist)
+
+    def prefetch_pages(self, generator):
+        """
+        Load the histories of the upcoming pages.
+
+        The pending revisions are queued for ORES, so the scores of the
+        next pages are fetched with the same batch as the page being
+        checked.
+        """
+        for page in generator:
+           flaggedinfo=getattr(page, '_flaggedinfo', None)
+           if (flaggedinfo and not self.window and page.namespace() == 0
+              and not self.unchanged_blocking(page, flaggedinfo)):
+              try:
+                 history=self.load_history(page, flaggedinfo)
+                 self.queue_ores(self.get_state(page.site), history.pending)
+                 page._history=history
+              except Exception as e:
+                 # The history is loaded again when the page is checked
+                 pywikibot.warning(u'Prefetching %s failed: %s' % (page.title(), e))
+           yield page
+
+    def history_windows(self, page, flaggedinfo):
+        """Yield the history in windows of at most self.window revisions."""
+        stable_revid=int(flaggedinfo.get("flagged", {}).get("stable_revid", 0))
+        for revs in self.history_revisions(page, flaggedinfo, 'ids|timestamp|user|sha1|size|tags',
+                                           self.window):
+           yield RevisionHistory([RevisionRecord.fromapi(rev) for rev in revs], stable_revid)
+
+    def get_ores_siteinfo(self, site):
+        sitename=site.dbName()
 
         url=('https://ores.wmflabs.org/v2/scores/%s' % sitename)
-        file=http.fetch(url)
-        data = json.loads(file.decode("utf-8"))
+        result=httpclient.get_json('ores', url)
+        if not result.ok:
+           pywikibot.error(u'Reading %s failed: %s' % (url, result.error))
+           return None
 
+        data=result.data
         if "scores" in data:
            if sitename in data["scores"]:
               return data["scores"][sitename]
 
-        return None
+        return {}
        
-    def get_oresrevs(self, rev_ids=[]):
-        if self._oresrevs==None:
-           site=pywikibot.Site()
-           url=(u'https://ores.wikimedia.org/scores/%swiki?models=damaging|reverted|goodfaith&revids=' % site.lang)
-           url=url + "|".join(str(key)  for key in rev_ids[:40])
-
-           try:
-              file=http.fetch(url)
-           except:
-              pywikibot.error(u'Reading %s failed' % url)
-              time.sleep(10)
-              file=http.fetch(url)
-           data = json.loads(file.decode("utf-8"))
-           self._oresrevs=data
-        return self._oresrevs
-
-    def test_oresrevs(self, rev_id, revlist, model):
-        if not model in self.oressiteinfo:
-           return False
+    def test_without_ores(self, ctx, rev):
+        """Return the first rule other than ORES which approves the revision."""
+        for rule in self.planner.order(self.available_data(ctx, rev)):
+           if rule.name == "ores":
+              continue
+           reason=rule.check(ctx, rev)
+           if reason:
+              return reason
+        return ""
+
+    def record_corpus(self, ctx, rev, approve_reason, blocked):
+        """
+        Write the revision to the corpus.
+
+        @param blocked: an earlier revision of the page was not ok, so the
+            revision was not tested yet
+        """
+        if blocked or approve_reason == "ores":
+           rule=self.test_without_ores(ctx, rev)
+        else:
+           # Every rule was tested if the revision was not approved
+           rule=approve_reason
 
-        if not self.oresconfig:
-           return False
+        scores=None
+        if not rule:
+           scores=ctx.state.oresscorer.get(rev.revid)
+        self.corpus.write(ctx.site, ctx.page.pageid, rev, rule, scores)
 
-        if not model in self.oresconfig:
-           return False  
+    def ores_enabled(self, state, model="goodfaith"):
+        """Test if the ORES rule can use the model on the site."""
+        return bool(self.oresconfig and model in self.oresconfig and model in state.oressiteinfo)
+
+    def test_oresrevs(self, state, rev_id, model):
+        if not self.ores_enabled(state, model):
+           return False
 
         settings=self.oresconfig[model]
-        oresrevs=self.get_oresrevs(revlist)
+        ores_rev=state.oresscorer.get(rev_id)
 
-        if str(rev_id) in oresrevs:
-           ores_rev=oresrevs[str(rev_id)]
+        if ores_rev:
            if model in ores_rev:
               if "probability" in ores_rev[model]:
                   scorer=ores_rev[model]["probability"]
@@ -178,60 +2129,98 @@ class PendingChangesRobot(object):
                       return True
         return False
 
-    def get_patrolledrevs(self, page, offset_time):
-        site=pywikibot.Site()
-        if self._patrolledrevs==None:
-           log_gen=site.logevents(logtype="patrol", page=page, end=offset_time)
-	   self._patrolledrevs = [entry.current_id for entry in log_gen]
-        return self._patrolledrevs
-
-    def test_patrolledrevs(self, page, rev_id, fp_pending_since):
-        patrolledrevs=self.get_patrolledrevs(page.title(), fp_pending_since);
-        if rev_id in patrolledrevs:
+    def get_patrolledrevs(self, ctx):
+        if ctx.patrolledrevs==None:
+           apilimiter.wait(ctx.site)
+           log_gen=ctx.site.logevents(logtype="patrol", page=ctx.page.title(), end=ctx.pending_since)
+           ctx.patrolledrevs = [entry.current_id for entry in log_gen]
+        return ctx.patrolledrevs
+
+    def test_patrolledrevs(self, ctx, rev):
+        patrollog=ctx.state.patrollog
+        if patrollog.covers(rev.timestamp):
+           return 1 if rev.revid in patrollog else 0
+
+        # Revision is older than the patrol log window
+        patrolledrevs=self.get_patrolledrevs(ctx)
+        if rev.revid in patrolledrevs:
             return 1
         else:
             return 0
 
-    def wordtest(self, parenttext, oldrevtext, latesttext):
-        oldrevwords = set(re.split(r"\s+",oldrevtext))
-        parentwords = set(re.split(r"\s+",parenttext))
-        latestwords = set(re.split(r"\s+",latesttext))
-        addedwords  = []
-        removedwords= []
-        existingwords= []
-
-        for word in oldrevwords:
-            if word not in parentwords:
-               addedwords.append(word)
-
-        for word in parentwords:
-            if word not in oldrevwords:
-               removedwords.append(word)
-
-        for word in addedwords:
-            if word in latestwords:
-               existingwords.append(word)
+    def wordtest(self, parentwords, oldrevwords, latestwords):
+        addedwords  = oldrevwords - parentwords
+        removedwords= parentwords - oldrevwords
 
         if (len(addedwords) == 0 and len(removedwords)==0):
             return 1
-        elif (len(existingwords)>0):
+        elif not addedwords.isdisjoint(latestwords):
             return 2
         else:
             return 0
 
-    def remove_interwiki(self, str):
-        iwlist="(aa|ab|ace|ady|af|ak|als|am|an|ang|ar|arc|arz|as|ast|av|ay|az|azb|ba|bar|bat-smg|bcl|be|be-tarask|bg|bh|bi|bjn|bm|bn|bo|bpy|br|bs|bug|bxr|ca|cbk-zam|cdo|ce|ceb|ch|cho|chr|chy|ckb|co|cr|crh|cs|csb|cu|cv|cy|da|de|diq|dsb|dty|dv|dz|ee|el|eml|en|eo|es|et|eu|ext|fa|ff|fi|fiu-vro|fj|fo|fr|frp|frr|fur|fy|ga|gag|gan|gd|gl|glk|gn|gom|got|gu|gv|ha|hak|haw|he|hi|hif|ho|hr|hsb|ht|hu|hy|hz|ia|id|ie|ig|ii|ik|ilo|io|is|it|iu|ja|jam|jbo|jv|ka|kaa|kab|kbd|kg|ki|kj|kk|kl|km|kn|ko|koi|kr|krc|ks|ksh|ku|kv|kw|ky|la|lad|lb|lbe|lez|lg|li|lij|lmo|ln|lo|lrc|lt|ltg|lv|mai|map-bms|mdf|mg|mh|mhr|mi|min|mk|ml|mn|mo|mr|mrj|ms|mt|mus|mwl|my|myv|mzn|na|nah|nap|nds|nds-nl|ne|new|ng|nl|nn|no|nov|nrm|nso|nv|ny|oc|olo|om|or|os|pa|pag|pam|pap|pcd|pdc|pfl|pi|pih|pl|pms|pnb|pnt|ps|pt|qu|rm|rmy|rn|ro|roa-rup|roa-tara|ru|rue|rw|sa|sah|sc|scn|sco|sd|se|sg|sh|si|simple|sk|sl|sm|sn|so|sq|sr|srn|ss|st|stq|su|sv|sw|szl|ta|tcy|te|tet|tg|th|ti|tk|tl|tn|to|tpi|tr|ts|tt|tum|tw|ty|tyv|udm|ug|uk|ur|uz|ve|vec|vep|vi|vls|vo|wa|war|wo|wuu|xal|xh|xmf|yi|yo|za|zea|zh|zh-classical|zh-min-nan|zh-yue|zu)";
-        return re.sub("\[\[" + iwlist + ":[^\]\n]*?\]\]", "", str).strip()
-
-    def test_content(self, page, rev_id, rev_parent_id):
-        latesttext=page.get(get_redirect=True)
-        oldrevtext=page.getOldVersion(rev_id)
+    def content_candidates(self, ctx, rev, limit=None):
+        """Yield the revision and the next pending revisions which can reach the content test."""
+        state=ctx.state
+        found=False
+        count=0
+        for pending in ctx.history.pending:
+           if pending is rev:
+              found=True
+           if not found:
+              continue
+           # Revisions approved by user rights never reach content tests
+           if pending is not rev and (state.userrights.is_bot(pending.user)
+              or state.userrights.is_autoreviewed(pending.user)
+              or pending.user in state.formerbotusers):
+              continue
+           if limit is not None and count >= limit:
+              break
+           count+=1
+           yield pending
+
+    def texts_cached(self, ctx, rev):
+        """Test if the texts the content test of the revision needs are cached."""
+        textcache=ctx.state.textcache
+        return (ctx.latest_revid in textcache and rev.revid in textcache
+                and (rev.parentid == 0 or rev.parentid in textcache))
+
+    def prefetch_texts(self, ctx, rev):
+        """
+        Fetch the texts which the content test of the revision needs.
+
+        When the content test has already approved a revision of the page
+        the next revisions are likely to be tested too, so their texts are
+        fetched in the same request.
+        """
+        limit=1 + (self.textlookahead if ctx.contentapproved else 0)
+        rev_ids=[ctx.latest_revid]
+        for pending in self.content_candidates(ctx, rev, limit):
+           rev_ids.append(pending.revid)
+           rev_ids.append(pending.parentid)
+        ctx.state.textcache.prefetch(ctx.site, rev_ids)
+
+    def check_content(self, ctx, rev):
+        test=self.test_content_diff if self.serverdiff else self.test_content
+        result=test(ctx, rev)
+        if result in self.contentreasons:
+           ctx.contentapproved=True
+        return result
+
+    def test_content(self, ctx, rev):
+        if not self.texts_cached(ctx, rev):
+           self.prefetch_texts(ctx, rev)
+
+        site=ctx.site
+        textcache=ctx.state.textcache
+        latesttext=textcache.fetch(site, ctx.latest_revid)
+        oldrevtext=textcache.fetch(site, rev.revid)
 
         # First revision
-        if rev_parent_id == 0 :
+        if rev.parentid == 0 :
            parenttext=""
         else:
-           parenttext=page.getOldVersion(int(rev_parent_id))
+           parenttext=textcache.fetch(site, rev.parentid)
 
         if latesttext == None:
            return False
@@ -242,93 +2231,196 @@ class PendingChangesRobot(object):
         if parenttext == None:
            return False
 
+        norm=ctx.state.normalizer
+        latest_id=ctx.latest_revid
+
         # Basic cleanup
-        latesttext=latesttext.lower().strip()
-        oldrevtext=oldrevtext.lower().strip()
-        parenttext=parenttext.lower().strip()
+        oldrevnorm=norm.text(rev.revid, oldrevtext)
+        parentnorm=norm.text(rev.parentid, parenttext)
 
         # Revisions are identical
-        if oldrevtext==parenttext:
+        if oldrevnorm==parentnorm:
            return "nochange"
 
         # Remove interwiki links (mostly good and moved to wikidata)
-        parenttext=self.remove_interwiki(parenttext)
-        oldrevtext=self.remove_interwiki(oldrevtext)
+        oldrevnorm=norm.text(rev.revid, oldrevtext, interwiki=True)
+        parentnorm=norm.text(rev.parentid, parenttext, interwiki=True)
 
-        if oldrevtext==parenttext:
+        if oldrevnorm==parentnorm:
            return "interwiki"
 
         # Split text to words and check what was added or removed
-        testresult=self.wordtest(parenttext, oldrevtext, latesttext);
+        testresult=self.wordtest(norm.words(rev.parentid, parenttext, interwiki=True),
+                                 norm.words(rev.revid, oldrevtext, interwiki=True),
+                                 norm.words(latest_id, latesttext))
         if testresult == 1:
            return "wordtest1"
 
-        # Remove special characters
-        wikicleanup="[\[\]\{\}\|.,:;'\"<>()\-–*]+"
-        oldrevtext=re.sub(wikicleanup, " ", oldrevtext).strip()
-        parenttext=re.sub(wikicleanup, " ", parenttext).strip()
-        latesttext=re.sub(wikicleanup, " ", latesttext).strip()
+        # Nothing that the edit changed is left in the latest version
+        if self.test_notinlatest(norm, rev, parenttext, oldrevtext, latest_id, latesttext):
+           return "notinlatest"
 
-        # Split text to words and check what was added or removed
-        testresult=self.wordtest(parenttext, oldrevtext, latesttext);
+        # Split text to words without special characters and check again
+        testresult=self.wordtest(norm.words(rev.parentid, parenttext, interwiki=True, cleanup=True),
+                                 norm.words(rev.revid, oldrevtext, interwiki=True, cleanup=True),
+                                 norm.words(latest_id, latesttext, cleanup=True))
         if testresult == 2:
            return "wordtest2"
         else:
            return ""
 
-    def review(self, rev_id, comment):
-           if self.simulateMode:
-              return True
+    def prefetch_diffs(self, ctx, rev):
+        """Fetch the diffs which content tests of the page may need."""
+        ctx.diffs=fetch_diffs(ctx.site, list(self.content_candidates(ctx, rev)))
+
+    def test_content_diff(self, ctx, rev):
+        """
+        Run the content tests on the diff of the revision.
+
+        Only the changed lines and the latest text of the page are used.
+        The words of the changed lines are compared instead of the words
+        of the whole texts.
+        """
+        # First revisions and missing diffs are tested using the full texts
+        if rev.parentid == 0:
+           return self.test_content(ctx, rev)
+        if ctx.diffs is None or rev.revid not in ctx.diffs:
+           self.prefetch_diffs(ctx, rev)
+        hunks=ctx.diffs.get(rev.revid)
+        if hunks is None:
+           return self.test_content(ctx, rev)
+
+        norm=ctx.state.normalizer
+        deleted=u'\n'.join(hunks.deleted).lower().strip()
+        added=u'\n'.join(hunks.added).lower().strip()
+
+        # Revisions are identical. Moved paragraphs look identical in the
+        # changed lines.
+        if deleted==added and not hunks.moved:
+           return "nochange"
+
+        # Remove interwiki links (mostly good and moved to wikidata)
+        deleted=norm.interwiki.sub("", deleted).strip()
+        added=norm.interwiki.sub("", added).strip()
+
+        if deleted==added and not hunks.moved:
+           return "interwiki"
+
+        # Words added or removed by the changed lines
+        if self.wordtest(frozenset(norm.whitespace.split(deleted)),
+                         frozenset(norm.whitespace.split(added)), frozenset()) == 1:
+           return "wordtest1"
+
+        # Nothing that the edit changed is left in the latest version
+        latest_id=ctx.latest_revid
+        if rev.revid == latest_id:
+           return ""
+        latesttext=ctx.state.textcache.fetch(ctx.site, latest_id)
+        if latesttext == None:
+           return ""
+
+        size=3
+        deletedtokens=tuple(norm.whitespace.split(norm.wikicleanup.sub(" ", deleted).strip()))
+        addedtokens=tuple(norm.whitespace.split(norm.wikicleanup.sub(" ", added).strip()))
+        latestshingles=norm.shingles(latest_id, latesttext, size, cleanup=True)
 
-           site=pywikibot.Site()
-           edittoken = site.tokens['edit']
-           parameters={'action':'review', 'revid':rev_id, 'flag_accuracy': 1, 'token': edittoken, 'comment': comment}
+        spans=self.tokendiff.spans(deletedtokens, addedtokens)
+        if not spans or not (spans[0] or spans[1]):
+           return ""
+        inserted, removed=spans
+
+        for start, end in inserted:
+           # Changed lines from different parts of the page are joined, so
+           # the context of a span can be made of unrelated lines. Spans
+           # shorter than a word sequence are tested only with their
+           # context, so they are tested using the full texts.
+           if end - start < size:
+              return self.test_content(ctx, rev)
+           if self.tokendiff.present(addedtokens, start, end, latestshingles, size):
+              return ""
+
+        for start, end in removed:
+           if not self.tokendiff.present(deletedtokens, start, end, latestshingles, size, everywhere=True):
+              return ""
+
+        return "notinlatest"
+
+    def test_notinlatest(self, norm, rev, parenttext, oldrevtext, latest_id, latesttext):
+        """
+        Test if no content from the edit is in the latest version.
+
+        Inserted text must be gone from the latest version and deleted text
+        must be back in it.
+        """
+        if rev.revid == latest_id:
+           return False
 
-           try:
-              req = api.Request(site=site, parameters=parameters)
-              req.submit()
-           except api.APIError as e:
-              pywikibot.error("There was an API error when reviewing the edit: %s" % json.dumps(self.simulateMode))
+        size=3
+        parenttokens=norm.tokens(rev.parentid, parenttext, interwiki=True, cleanup=True)
+        oldrevtokens=norm.tokens(rev.revid, oldrevtext, interwiki=True, cleanup=True)
+        latestshingles=norm.shingles(latest_id, latesttext, size, cleanup=True)
+
+        spans=self.tokendiff.spans(parenttokens, oldrevtokens)
+        if spans is None:
+           # Diff was too expensive. Accept only additions whose words are
+           # all missing from the latest version.
+           parentwords=norm.words(rev.parentid, parenttext, interwiki=True, cleanup=True)
+           oldrevwords=norm.words(rev.revid, oldrevtext, interwiki=True, cleanup=True)
+           latestwords=norm.words(latest_id, latesttext, cleanup=True)
+           addedwords=oldrevwords - parentwords
+           return (bool(addedwords) and parentwords <= oldrevwords
+                   and addedwords.isdisjoint(latestwords))
+
+        inserted, deleted=spans
+        if not inserted and not deleted:
+           return False
+
+        for start, end in inserted:
+           if self.tokendiff.present(oldrevtokens, start, end, latestshingles, size):
               return False
-           else:
-              return True
 
-    def flaggedinfo(self, page):
-        site=pywikibot.Site()
-        url=(u'https://%s.%s.org/w/api.php?format=json&action=query&prop=info|flagged&pageids=%d' % (site.lang, site.family, page.pageid))
+        for start, end in deleted:
+           if not self.tokendiff.present(parenttokens, start, end, latestshingles, size, everywhere=True):
+              return False
 
-        file=http.fetch(url)
-        data = json.loads(file.decode("utf-8"))
+        return True
 
-        if data["query"] and data["query"]["pages"]:
-           pageid=str(page.pageid)
-           if pageid in data["query"]["pages"]:
-               return data["query"]["pages"][pageid]
-           else:
-               pywikibot.error("Flaggedinfo error. Page not found.")
-               exit(1)
+    def review(self, page, rev_id, comment):
+           """Queue the review. Evaluation of next pages continues meanwhile."""
+           if self.simulateMode:
+              return True
 
-        return {}
+           self.get_state(page.site).reviews.submit(page.title(), rev_id, comment)
+           return True
 
-    def login(self):
+    def flaggedinfo(self, page):
+        # Pages from flaggedinfoGenerator are already resolved
+        if hasattr(page, '_flaggedinfo'):
+           return page._flaggedinfo
+
+        data=get_flaggedinfo(page.site, [page])
+        if page.pageid in data:
+           return data[page.pageid]
+        else:
+           pywikibot.error("Flaggedinfo error. Page not found.")
+           exit(1)
+
+    def login(self, site):
         if self.simulateMode:
            return True
 
-        site=pywikibot.Site()
-        site.login()
-        return site.logged_in()
-
-    def create_comment(self, approves):
-        users=set()
-        rules=set()
-        revs=set()
-        for row in approves:
-           users.add(row["rev"]["user"])
-           revs.add(row["rev"]["revid"])
-           rules.add(row["approve_reason"])
-
-        rev_plural= 'revisions' if len(revs)>1 else 'revision'
-        user_plural= 'users' if len(users)>1 else 'user'
+        with self._loginlock:
+           if not site.logged_in():
+              site.login()
+           return site.logged_in()
+
+    def create_comment(self, state, summary):
+        users=summary.users
+        rules=summary.rules
+        revs=summary.revids
+
+        rev_plural= 'revisions' if summary.count>1 else 'revision'
+        user_plural= 'users' if len(users)>1 or summary.moreusers else 'user'
         rule_plural= 'rules' if len(rules)>1 else 'rule'
 
         rev_delim= ' and ' if len(revs)==2 else ', '
@@ -342,21 +2434,21 @@ class PendingChangesRobot(object):
         vars=(rev_plural, revs_str, user_plural, users_str, rule_plural, rules_str)
         comment=("Approved %s %s from %s %s using %s %s" % vars)
 
-        # If the comment is too long then make a shorter one
-        if (len(comment)>150):
+        # If the comment is too long or the users are hidden then make a shorter one
+        if (len(comment)>150 or not users):
            vars=(rev_plural, revs_str, rule_plural, rules_str)
            comment=("Approved %s %s using %s %s" % vars)
 
         # If the comment is still too long then make a shorter one
         if (len(comment)>150):
-           vars=(len(revs), rev_plural, rule_plural, rules_str)
+           vars=(summary.count, rev_plural, rule_plural, rules_str)
            comment=("Approved %d %s using %s %s" % vars)
 
         # If the comment is for a single edit then add more info
-	if (len(revs)==1 and "ores" in rules):
-           oresrevs=self.get_oresrevs()
-           goodfaith_true=oresrevs[str(list(revs)[0])]["goodfaith"]["probability"]["true"]
-           goodfaith_false=oresrevs[str(list(revs)[0])]["goodfaith"]["probability"]["false"]
+        if (summary.count==1 and "ores" in rules):
+           ores_rev=state.oresscorer.get(list(revs)[0])
+           goodfaith_true=ores_rev["goodfaith"]["probability"]["true"]
+           goodfaith_false=ores_rev["goodfaith"]["probability"]["false"]
 
            comment+=(' goodfaith (t/f: %.2f/%.2f)' % (goodfaith_true, goodfaith_false))
 
@@ -364,9 +2456,126 @@ class PendingChangesRobot(object):
 
 
 
+    def get_rules(self):
+        """Return the approval rules."""
+        rules=[
+           ApprovalRule("bot", lambda ctx, rev: ctx.state.userrights.is_bot(rev.user), ("userrights",)),
+           ApprovalRule("autoreview", lambda ctx, rev: ctx.state.userrights.is_autoreviewed(rev.user),
+                        ("userrights",)),
+           ApprovalRule("formerbot", lambda ctx, rev: rev.user in ctx.state.formerbotusers, ("formerbots",)),
+           ApprovalRule("patrolled", self.test_patrolledrevs, ("patrollog",), cost=0.01),
+           ApprovalRule("reverted",
+                        lambda ctx, rev: self.test_revert(ctx.revertdetector, rev.revid, "reverted"),
+                        ("history",)),
+           ApprovalRule("revert",
+                        lambda ctx, rev: self.test_revert(ctx.revertdetector, rev.revid, "revert"),
+                        ("history",)),
+           ApprovalRule("ores", lambda ctx, rev: self.test_oresrevs(ctx.state, rev.revid, "goodfaith"), ("ores",),
+                        cost=0.01),
+           ApprovalRule("content", self.check_content,
+                        ("diffs",) if self.serverdiff else ("texts",), cost=0.1,
+                        reasons=self.contentreasons, tentative=("notinlatest",)),
+        ]
+
+        # Tool Labs is used only as a fallback
+        if self.usetoollabs:
+           rules.append(ApprovalRule("toollabs_reverted",
+                                     lambda ctx, rev: self.test_reverted(ctx.page, rev.revid, "reverted") and "reverted",
+                                     ("toollabs",), cost=0.5, reasons=("reverted",), remote=True))
+           rules.append(ApprovalRule("toollabs_revert",
+                                     lambda ctx, rev: self.test_reverted(ctx.page, rev.revid, "revert") and "revert",
+                                     ("toollabs",), cost=0.5, reasons=("revert",), remote=True))
+        return rules
+
+    def available_data(self, ctx, rev):
+        """Return the names of the data which rules can use without requests."""
+        available=set(("userrights", "formerbots"))
+        if ctx.revertdetector is not None:
+           available.add("history")
+        if ctx.state.patrollog.covers(rev.timestamp) or ctx.patrolledrevs is not None:
+           available.add("patrollog")
+        if self.ores_enabled(ctx.state) and ctx.state.oresscorer.scheduled(rev.revid):
+           available.add("ores")
+        if self.texts_cached(ctx, rev):
+           available.add("texts")
+        if ctx.diffs is not None and rev.revid in ctx.diffs:
+           available.add("diffs")
+        return available
+
     def treat(self, page):
-        pywikibot.output(u'\n>>> %s <<<' % page.title())
-        self.reset_pagecache()
+        ctx=PageContext(page)
+        ctx.state=self.get_state(page.site)
+        try:
+            if self.profilefile:
+                self.get_profile().runcall(self.treat_page, ctx)
+            else:
+                self.treat_page(ctx)
+        finally:
+            ctx.flush()
+            metrics.count(pages=1)
+
+        # Long running bot stores caches and statistics now and then
+        if time.time() - self._lastsave > 600:
+            self._lastsave=time.time()
+            self.save_caches()
+        if self.promfile and time.time() - self._lastprom > 60:
+            self._lastprom=time.time()
+            metrics.write_prometheus(self.promfile)
+
+    def get_profile(self):
+        """Return the profiler of the current thread."""
+        profile=getattr(self._profiles, 'profile', None)
+        if profile is None:
+            profile=cProfile.Profile()
+            self._profiles.profile=profile
+            with self._loginlock:
+                self._allprofiles.append(profile)
+        return profile
+
+    def write_statistics(self):
+        if self.statsfile:
+            metrics.write_json(self.statsfile)
+        if self.promfile:
+            metrics.write_prometheus(self.promfile)
+        if self.profilefile and self._allprofiles:
+            stats=pstats.Stats(*self._allprofiles)
+            stats.dump_stats(self.profilefile)
+
+    def save_caches(self):
+        with self._stateslock:
+            states=list(self._states.values())
+        for state in states:
+            state.save()
+
+    def rule_config(self, rule):
+        """
+        Return the configuration which approvals of the rule depend on.
+
+        @return: string stored with the approvals or None if the rule is
+            disabled
+        """
+        if rule == "ores":
+           return json.dumps(self.oresconfig, sort_keys=True) if self.oresconfig else None
+        if rule == "formerbot":
+           return "formerbots" if self.useformerbots else None
+        return ""
+
+    def unchanged_blocking(self, page, flaggedinfo):
+        """Return the revision which was not ok in the last run if the page is unchanged."""
+        if not self.decisions:
+           return 0
+        stored=self.decisions.get_page(page.site, page.pageid)
+        if stored:
+           latest_revid, blocking_revid, checked=stored
+           if (blocking_revid
+              and latest_revid == flaggedinfo.get("lastrevid")
+              and time.time() - checked < self.recheckhours * 3600):
+              return blocking_revid
+        return 0
+
+    def treat_page(self, ctx):
+        page=ctx.page
+        ctx.output(u'\n>>> %s <<<' % page.title())
 
         if not page.exists():
             return True
@@ -374,125 +2583,452 @@ class PendingChangesRobot(object):
         if page.namespace() != 0:
            return True
 
-        site = page.site
         flaggedinfo=self.flaggedinfo(page)
-        oresconfig=self.oresconfig
+        ctx.flaggedinfo=flaggedinfo
 
         if "flagged" in flaggedinfo:
            if "pending_since" in flaggedinfo["flagged"]:
-               pending_since=dateutil.parser.parse(flaggedinfo["flagged"]["pending_since"])
+               pending_since=pywikibot.Timestamp.fromISOformat(flaggedinfo["flagged"]["pending_since"])
            else:
                # Already reviewed
                return True
         else:
            pending_since=None
-
-        rev_gen = page.revisions(reverse=True, starttime=pending_since, content=False)
-        revlist=[]
-        for rev in rev_gen:
-           if (rev["user"] not in self.botusers and rev["user"] not in self.autoreviewdusers):
-              revlist.append(int(rev["revid"]))
-
-        # reset revision generator
-        rev_gen = page.revisions(reverse=True, starttime=pending_since, content=False)
-
+        ctx.pending_since=pending_since
+
+        # Decisions from earlier runs
+        earlier={}
+        if self.decisions:
+           blocking_revid=self.unchanged_blocking(page, flaggedinfo)
+           if blocking_revid:
+              ctx.output(u'Skipping unchanged page. Revision %d was not ok in the last run.' % blocking_revid)
+              return True
+           earlier={revid:rule for revid, (rule, config) in self.decisions.get_approved(page.site, page.pageid).items()
+                    if rule in self.reusablerules and config is not None and config == self.rule_config(rule)}
+
+        if self.window:
+           # Long histories are fetched and checked a window at a time and
+           # fetching stops at the first revision which is not ok. Reverts
+           # are found from the windows fetched so far.
+           windows=self.history_windows(page, flaggedinfo)
+           stable_revid=int(flaggedinfo.get("flagged", {}).get("stable_revid", 0))
+           ctx.revertdetector=RevertDetector((), [stable_revid])
+           ctx.latest_revid=int(flaggedinfo.get("lastrevid", 0)) or page.latest_revision_id
+        else:
+           # Revision metadata is fetched once. Reviewed revision is
+           # included so that reverts to it can be found.
+           history=getattr(page, '_history', None) or self.load_history(page, flaggedinfo)
+           page._history=None
+           ctx.revertdetector=RevertDetector(history, [history.stable_revid])
+           if history.revisions:
+              ctx.latest_revid=history.revisions[-1].revid
+           windows=[history]
+
+        state=ctx.state
         latest_ok=0
         latest_timestamp=None
-        approves=[]
-
-        for rev in rev_gen:
-           approve_reason=""
-           rev_id=int(rev["revid"])
-           rev_user=rev["user"]
-           rev_timestamp=rev["timestamp"]
-           rev_parent_id=rev.parent_id
-
-           if rev_user in self.botusers:
-              approve_reason="bot"
-              latest_ok=rev_id
-           elif rev_user in self.autoreviewdusers :
-              approve_reason="autoreview"
-              latest_ok=rev_id
-           elif rev_user in self.formerbotusers :
-              approve_reason="formerbot"
-              latest_ok=rev_id
-           elif self.test_patrolledrevs(page, rev_id, pending_since):
-              approve_reason="patrolled"
-              latest_ok=rev_id
-           elif self.test_reverted(page, rev_id, "reverted"):
-              approve_reason="reverted"
-              latest_ok=rev_id
-           elif self.test_reverted(page, rev_id, "revert"):
-              approve_reason="revert"
-              latest_ok=rev_id
-           elif self.test_oresrevs(rev_id, revlist, "goodfaith"):
-              approve_reason="ores"
-              latest_ok=rev_id
-           else:
-
-              # Try to figure out what to do using diff
-              test_result=self.test_content(page, rev_id, rev_parent_id)
-
-              if test_result=="nochange":
-                   approve_reason="nochange"
-                   latest_ok=rev_id
-              elif test_result=="interwiki":
-                   approve_reason="interwiki"
-                   latest_ok=rev_id
-
-           state='OK' if approve_reason!="" else 'NOT OK'
-           pywikibot.output(u'%s\t%s Revision %d %s %s' % (state, "{:<15}".format(approve_reason), rev_id, rev_timestamp, rev_user))
-
-           if approve_reason != "":
-              latest_ok=rev_id
-              latest_timestamp=rev_timestamp
-              row={ 'rev':rev, 'approve_reason':approve_reason}
-              approves.append(row)
-           else:
+        blocking_revid=0
+        # Approved revisions are listed only when they are stored
+        summary=ApprovalSummary(bool(self.decisions and self.savestate))
+        # Result before the first notinlatest approval. The approval is
+        # valid only if the latest version is approved too.
+        rollback=None
+
+        for history in windows:
+           ctx.history=history
+           if self.window:
+              ctx.revertdetector.extend(history)
+           if not history.pending:
+              continue
+
+           state.patrollog.ensure(history.pending[0].timestamp)
+
+           # Rights of all the users of the window are looked up at once
+           self.queue_ores(state, [rev for rev in history.pending if rev.revid not in earlier])
+
+           for rev in history.pending:
+              if blocking_revid:
+                 # Revisions after the first one which is not ok are tested
+                 # only for the corpus
+                 self.record_corpus(ctx, rev, "", True)
+                 continue
+
+              approve_reason=""
+              rev_id=rev.revid
+              rev_user=rev.user
+              rev_timestamp=rev.timestamp
+
+              if rev_id in earlier:
+                 # Approved in an earlier run
+                 approve_reason=earlier[rev_id]
+              else:
+                 # Rules with prefetched data and cheap rules are tested first
+                 approve_reason=self.planner.evaluate(ctx, rev, self.available_data(ctx, rev))
+
+              metrics.count(revisions=1)
+              status='OK' if approve_reason!="" else 'NOT OK'
+              ctx.output(u'%s\t%s Revision %d %s %s' % (status, "{:<15}".format(approve_reason), rev_id, rev_timestamp, rev_user))
+              if self.corpus:
+                 self.record_corpus(ctx, rev, approve_reason, False)
+
+              if approve_reason == "notinlatest" and rollback is None:
+                 rollback=(latest_ok, latest_timestamp, summary.copy())
+
+              if approve_reason != "":
+                 latest_ok=rev_id
+                 latest_timestamp=rev_timestamp
+                 summary.add(rev, approve_reason)
+              else:
+                 blocking_revid=rev_id
+                 if not self.corpus:
+                    break
+
+           if self.decisions and self.savestate and ctx.latest_revid:
+              approved=[(revid, rule, self.rule_config(rule)) for revid, rule in summary.pop_approved()]
+              self.decisions.record(page.site, page.pageid, ctx.latest_revid,
+                                    blocking_revid, approved)
+           if blocking_revid and not self.corpus:
               break
 
+        if blocking_revid and rollback:
+           ctx.output(u'Revision %d was not ok, ignoring the notinlatest approvals.' % blocking_revid)
+           latest_ok, latest_timestamp, summary=rollback
+
         if latest_ok :
-           pywikibot.output(u'Latest ok revision: %d' % latest_ok)           
+           ctx.output(u'Latest ok revision: %d' % latest_ok)           
            if (page.latest_revision_id != latest_ok 
               and self.daylimit 
               and datetime.datetime.now() > (latest_timestamp + datetime.timedelta(days=self.daylimit))):
-                  pywikibot.output(u'Skipping review of revision: %d because it is older than %d days."' % (latest_ok,self.daylimit))              
-           elif self.login():
-              comment=self.create_comment(approves)
-              result=self.review(rev_id=latest_ok, comment=comment)
+                  ctx.output(u'Skipping review of revision: %d because it is older than %d days."' % (latest_ok,self.daylimit))              
+           elif self.login(page.site):
+              comment=self.create_comment(state, summary)
+              result=self.review(page, rev_id=latest_ok, comment=comment)
               if result:
                  if self.simulateMode:
-                     pywikibot.output('Reviewed (simulated) revision: %d with comment: "%s"' % (latest_ok,comment))
+                     ctx.output('Reviewed (simulated) revision: %d with comment: "%s"' % (latest_ok,comment))
                  else:
-                     pywikibot.output('Reviewed revision: %d with comment: "%s"' % (latest_ok,comment))
+                     ctx.output('Queued review of revision: %d with comment: "%s"' % (latest_ok,comment))
 
 
     def run(self):
-        site=pywikibot.Site()
-        pywikibot.output(u'Family: %s ; Lang %s' % (site.family, site.lang) )
         pywikibot.output(u'Ores config: %s' % json.dumps(self.oresconfig) )
 
-        self.autoreviewdusers=self.get_autoreviewedusers()
-        self.botusers=self.get_botusers()
-        if self.useformerbots:
-            self.formerbotusers=self.get_formerbotusers()
-
         """Check each page passed."""
-        for page in self.generator:
-            self.treat(page)
+        # Histories of the upcoming pages are loaded in the background
+        generator=readaheadGenerator(self.prefetch_pages(self.generator), self.lookahead)
+        try:
+            if self.workers > 1:
+                self.run_workers(generator)
+            else:
+                for page in generator:
+                    self.treat(page)
+        finally:
+            for state in self._states.values():
+                state.reviews.close()
+            self.save_caches()
+            self.write_statistics()
+            if self.decisions:
+                self.decisions.close()
+            if self.corpus:
+                self.corpus.close()
+
+    def run_workers(self, generator):
+        """Check pages using a pool of worker threads."""
+        pages=queue.Queue(self.workers * 2)
+
+        def worker():
+            while True:
+                page=pages.get()
+                if page is None:
+                    break
+                try:
+                    self.treat(page)
+                except Exception as e:
+                    pywikibot.error(u'Processing %s failed' % page.title())
+                    pywikibot.exception(e)
+
+        threads=[]
+        for i in range(self.workers):
+            thread=threading.Thread(target=worker)
+            thread.daemon=True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for page in generator:
+                pages.put(page)
+        finally:
+            for thread in threads:
+                pages.put(None)
+            for thread in threads:
+                thread.join()
+
+
+def query_continue(site, parameters):
+    """Yield the results of an API query following query continuation."""
+    parameters=dict(parameters)
+    parameters['continue']=''
+    endpoint='api:%s' % parameters.get('prop', parameters.get('list', parameters['action']))
+    while True:
+        apilimiter.wait(site)
+        req = api.Request(site=site, parameters=parameters)
+        with metrics.timed(endpoint):
+            data = req.submit()
+        yield data
+        if 'continue' not in data:
+            break
+        parameters.update(data['continue'])
+
+def get_flaggedinfo(site, pages=None, titles=None):
+    """Return flagged info of the pages as a dict keyed by page id."""
+    if titles is None:
+        titles=[page.title() for page in pages]
+    parameters={'action':'query', 'prop':'info|flagged', 'titles':'|'.join(titles)}
+    apilimiter.wait(site)
+    req = api.Request(site=site, parameters=parameters)
+    with metrics.timed('api:flagged'):
+        data = req.submit()
+
+    result={}
+    if "query" in data and "pages" in data["query"]:
+       pages=data["query"]["pages"]
+       if isinstance(pages, dict):
+          pages=pages.values()
+       for pageinfo in pages:
+          if "pageid" in pageinfo:
+             result[int(pageinfo["pageid"])]=pageinfo
+    return result
+
+def is_reviewed(flaggedinfo):
+    return "flagged" in flaggedinfo and "pending_since" not in flaggedinfo["flagged"]
+
+def flaggedinfoGenerator(generator, site=None):
+    """
+    Prefetch flagged info for pages in batches.
+
+    Each yielded page has its flagged info in the _flaggedinfo attribute and
+    its page info loaded from the same query, so the pages don't need to be
+    preloaded. Pages which are already reviewed or don't exist are dropped.
+    """
+    if site is None:
+        site = pywikibot.Site()
+    batchsize = 500 if site.has_right('apihighlimits') else 50
+
+    def prefetch(batch):
+        data=get_flaggedinfo(site, batch)
+        bytitle={flaggedinfo["title"]:flaggedinfo for flaggedinfo in data.values()}
+        for page in batch:
+            flaggedinfo=bytitle.get(page.title())
+            if flaggedinfo is None or is_reviewed(flaggedinfo):
+                continue
+            api.update_page(page, flaggedinfo)
+            page._flaggedinfo=flaggedinfo
+            yield page
+
+    batch=[]
+    for page in generator:
+        batch.append(page)
+        if len(batch) >= batchsize:
+            for page in prefetch(batch):
+                yield page
+            batch=[]
+    if batch:
+        for page in prefetch(batch):
+            yield page
+
+def recentchangesStream(site, interval=10):
+    """Yield new article edits from recent changes, polling forever."""
+    parameters={'action':'query', 'list':'recentchanges', 'rcprop':'title|ids|timestamp',
+                'rcnamespace':0, 'rctype':'edit|new', 'rcdir':'newer', 'rclimit':'max',
+                'rcstart':pywikibot.Timestamp.utcnow().isoformat()}
+    seen=set()
+    while True:
+        latest=parameters['rcstart']
+        for data in query_continue(site, parameters):
+            for change in data["query"]["recentchanges"]:
+                # Changes at the start timestamp were seen in the last poll
+                if change["rcid"] in seen:
+                    continue
+                if change["timestamp"] != latest:
+                    latest=change["timestamp"]
+                    seen=set()
+                seen.add(change["rcid"])
+                yield {'title':change["title"], 'revid':change["revid"]}
+        parameters['rcstart']=latest
+        time.sleep(interval)
+
+def jsonlinesStream(site, source):
+    """
+    Yield article edits from EventStreams style JSON lines.
+
+    Source is a file name, - for standard input or tcp:host:port. This is
+    used for replaying recorded streams.
+    """
+    if source == '-':
+        lines=sys.stdin
+    elif source.startswith('tcp:'):
+        host, port=source[4:].rsplit(':', 1)
+        lines=socket.create_connection((host, int(port))).makefile('r')
+    else:
+        lines=open(source)
+
+    for line in lines:
+        line=line.strip()
+        if not line:
+            continue
+        try:
+            change=json.loads(line)
+        except ValueError:
+            pywikibot.warning(u'Invalid stream line: %s' % line)
+            continue
+        if change.get("wiki", site.dbName()) != site.dbName():
+            continue
+        if change.get("namespace", 0) != 0 or change.get("type", "edit") not in ("edit", "new"):
+            continue
+        yield {'title':change["title"], 'revid':change.get("revision", {}).get("new")}
+
+def debouncedTitles(changes, debounce):
+    """
+    Yield lists of titles which have not been edited for debounce seconds.
+
+    Changes are read in a background thread so that bursts of edits to the
+    same page end up as a single title.
+    """
+    changequeue=queue.Queue()
+
+    def reader():
+        try:
+            for change in changes:
+                changequeue.put(change)
+        finally:
+            changequeue.put(None)
+
+    thread=threading.Thread(target=reader)
+    thread.daemon=True
+    thread.start()
+
+    pending=OrderedDict()
+    while True:
+        now=time.time()
+        due=[title for title, edited in pending.items() if now - edited >= debounce]
+        if due:
+            for title in due:
+                del pending[title]
+            yield due
+            continue
+
+        if pending:
+            timeout=min(pending.values()) + debounce - now
+        else:
+            timeout=3600
+        try:
+            change=changequeue.get(timeout=timeout)
+        except queue.Empty:
+            continue
+
+        if change is None:
+            # Stream ended
+            if pending:
+                yield list(pending)
+            return
+        pending.pop(change["title"], None)
+        pending[change["title"]]=time.time()
+
+def streamGenerator(site, changes, debounce=30):
+    """Yield pages with pending changes from a stream of edits."""
+    for titles in debouncedTitles(changes, debounce):
+        for i in range(0, len(titles), 50):
+            data=get_flaggedinfo(site, titles=titles[i:i + 50])
+            for flaggedinfo in data.values():
+                if is_reviewed(flaggedinfo) or "flagged" not in flaggedinfo:
+                    continue
+                page=pywikibot.Page(site, flaggedinfo["title"])
+                api.update_page(page, flaggedinfo)
+                page._flaggedinfo=flaggedinfo
+                yield page
+
+def readaheadGenerator(generator, size):
+    """
+    Run a generator in a background thread.
+
+    Up to size items are buffered, so the stages of the page pipeline
+    overlap instead of waiting for each other.
+    """
+    items=queue.Queue(size)
+    done=object()
+    errors=[]
+
+    def producer():
+        try:
+            for item in generator:
+                items.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.put(done)
+
+    thread=threading.Thread(target=producer)
+    thread.daemon=True
+    thread.start()
+
+    while True:
+        item=items.get()
+        if item is done:
+            break
+        yield item
+
+    if errors:
+        raise errors[0]
+
+def mergedGenerator(generators, size):
+    """
+    Yield the items of several generators as they become available.
 
+    Each generator runs in its own background thread, so a slow or idle
+    wiki does not hold back pages of the other wikis.
+    """
+    items=queue.Queue(size)
+    done=object()
+    errors=[]
 
-def unreviewdpagesGenerator():
-    site = pywikibot.Site()
-    list_gen = api.ListGenerator(listaction="unreviewedpages", site=site,  urlimit=5, urnamespace=0, urfilterredir="nonredirects" )
+    def producer(generator):
+        try:
+            for item in generator:
+                items.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.put(done)
+
+    for generator in generators:
+        thread=threading.Thread(target=producer, args=(generator,))
+        thread.daemon=True
+        thread.start()
+
+    running=len(generators)
+    while running:
+        item=items.get()
+        if item is done:
+            running-=1
+            continue
+        yield item
+
+    if errors:
+        raise errors[0]
+
+def unreviewdpagesGenerator(listlimit=500, site=None):
+    if site is None:
+        site = pywikibot.Site()
+    list_gen = api.ListGenerator(listaction="unreviewedpages", site=site,  urlimit=listlimit, urnamespace=0, urfilterredir="nonredirects" )
 
     for entry in list_gen:
         page=pywikibot.Page(site, entry["title"])
         yield page
 
-def pendingchangesGenerator():
-    site = pywikibot.Site()
-    list_gen = api.ListGenerator(listaction="oldreviewedpages", site=site,  orlimit=5, ornamespace=0 )
+def pendingchangesGenerator(listlimit=500, site=None):
+    if site is None:
+        site = pywikibot.Site()
+    list_gen = api.ListGenerator(listaction="oldreviewedpages", site=site,  orlimit=listlimit, ornamespace=0 )
 
     for entry in list_gen:
         page=pywikibot.Page(site, entry["title"])
@@ -513,11 +3049,21 @@ def main(*args):
 
     # Page generator
     gen = None
+    listgen = None
+
+    # Number of pages listed per request and buffered between the stages
+    listlimit=500
+    readahead=100
 
-    # This factory is responsible for processing command line arguments
-    # that are also used by other scripts and that determine on which pages
-    # to work on.
-    genFactory = pagegenerators.GeneratorFactory()
+    # Revisions fetched and checked at a time. 0 loads the whole history.
+    window=0
+
+    # Use diffs from the server instead of full texts in content tests
+    serverdiff=0
+
+    # Arguments for the page generator factory. The factory is created
+    # only if no other page source is given.
+    genargs = []
 
 
     #Default values for ORES
@@ -531,17 +3077,162 @@ def main(*args):
     # Autoreview former bots
     formerbots=1
 
+    # Use Tool Labs as fallback for revert detection
+    toollabs=0
+
+    # Number of pages processed in parallel
+    workers=1
+
+    # Maximum size of cached revision texts in bytes
+    textcachesize=64 * 1024 * 1024
+
+    # Days of patrol log kept in memory
+    patrolwindow=30
+
+    # Store user rights to disk between runs
+    usercache=0
+
+    # Decisions of earlier runs. Simulated runs store decisions only to
+    # a file given with -state:FILE.
+    statefile=config.datafilepath('pendingchanges-state.sqlite')
+    savestate=None
+
+    # Snapshot of ORES models, former bots, interwiki prefixes and flagged
+    # revisions configuration
+    metadatafile=config.datafilepath('pendingchanges-metadata.json')
+    recheckhours=24
+
+    # Reviews per minute and maxlag of review requests
+    reviewrate=None
+    maxlag=5
+
+    # Performance statistics and profiling output files
+    statsfile=None
+    promfile=None
+    profilefile=None
+
+    # Read edits from recent changes (True) or from a JSON lines source
+    stream=None
+    debounce=30
+
+    # Record or replay responses of a run
+    transport=None
+
+    # Store ORES scores to disk between runs
+    orescache=1
+
+    # Rule outcomes and ORES scores of all pending revisions for ores_sweep.py
+    corpusfile=None
+
+    # Wikis processed in one process as (code, family) pairs
+    sitenames=[]
+
     for arg in pywikibot.handle_args(args):
         ores_arg=re.search('ores_(.*?)_(true|false)_(min|max):([0-9.]*?)$', arg)
 
         if arg == '-pendingchanges':
-            gen = pendingchangesGenerator()
+            listgen = pendingchangesGenerator
         elif arg == '-unreviewedpages':
-            gen = unreviewdpagesGenerator()
+            listgen = unreviewdpagesGenerator
+        elif arg.startswith('-listlimit:'):
+            try:
+                listlimit=int(arg[11:])
+            except:
+                pywikibot.error("Unsupported listlimit value")
+        elif arg == '-serverdiff':
+            serverdiff=1
+        elif arg.startswith('-window:'):
+            try:
+                window=int(arg[8:])
+            except:
+                pywikibot.error("Unsupported window value")
+        elif arg.startswith('-readahead:'):
+            try:
+                readahead=int(arg[11:])
+            except:
+                pywikibot.error("Unsupported readahead value")
         elif arg == '-noores':
             oresconfig=None
         elif arg == '-noformerbots':
             formerbots=0
+        elif arg == '-toollabs':
+            toollabs=1
+        elif arg.startswith('-workers:'):
+            try:
+                workers=int(arg[9:])
+            except:
+                pywikibot.error("Unsupported workers value")
+        elif arg.startswith('-textcache:'):
+            try:
+                textcachesize=int(arg[11:]) * 1024 * 1024
+            except:
+                pywikibot.error("Unsupported textcache value")
+        elif arg.startswith('-patrolwindow:'):
+            try:
+                patrolwindow=int(arg[14:])
+            except:
+                pywikibot.error("Unsupported patrolwindow value")
+        elif arg == '-usercache':
+            usercache=1
+        elif arg == '-stream':
+            stream=True
+        elif arg.startswith('-stream:'):
+            stream=arg[8:]
+        elif arg.startswith('-debounce:'):
+            try:
+                debounce=float(arg[10:])
+            except:
+                pywikibot.error("Unsupported debounce value")
+        elif arg.startswith('-reviewrate:'):
+            try:
+                reviewrate=float(arg[12:])
+            except:
+                pywikibot.error("Unsupported reviewrate value")
+        elif arg.startswith('-maxlag:'):
+            try:
+                maxlag=int(arg[8:])
+            except:
+                pywikibot.error("Unsupported maxlag value")
+        elif arg.startswith('-stats:'):
+            statsfile=arg[7:]
+        elif arg.startswith('-promfile:'):
+            promfile=arg[10:]
+        elif arg.startswith('-profile:'):
+            profilefile=arg[9:]
+        elif arg.startswith('-record:') and not transport:
+            transport=RecordReplay(arg[8:], 'record')
+            transport.install()
+        elif arg.startswith('-replay:') and not transport:
+            transport=RecordReplay(arg[8:], 'replay')
+            transport.install()
+        elif arg.startswith('-sites:'):
+            for name in arg[7:].split(','):
+                code, _, family=name.strip().partition(':')
+                if code:
+                    sitenames.append((code, family or config.family))
+        elif arg.startswith('-corpus:'):
+            corpusfile=arg[8:]
+        elif arg == '-nometadata':
+            metadatafile=None
+        elif arg == '-noorescache':
+            orescache=0
+        elif arg.startswith('-metadata:'):
+            metadatafile=arg[10:]
+        elif arg == '-nostate':
+            statefile=None
+        elif arg.startswith('-state:'):
+            statefile=arg[7:]
+            savestate=1
+        elif arg.startswith('-recheckhours:'):
+            try:
+                recheckhours=float(arg[14:])
+            except:
+                pywikibot.error("Unsupported recheckhours value")
+        elif arg.startswith('-apirate:'):
+            try:
+                apilimiter.rate=float(arg[9:])
+            except:
+                pywikibot.error("Unsupported apirate value")
         elif arg.startswith('-daylimit:'):
             try:
                 daylimit=int(arg[10:])
@@ -559,14 +3250,79 @@ def main(*args):
            else:
               pywikibot.error("Unsupported ORES key %s" % arg)
         else:
-            genFactory.handleArg(arg)
+            genargs.append(arg)
+
+    if savestate is None:
+        savestate=0 if config.simulate else 1
 
-    if gen==None:
-        gen = genFactory.getCombinedGenerator()
+    if transport:
+        # Recorded and replayed runs start without stored state, so they
+        # make the same requests and don't change the files of real runs
+        statefile=None
+        metadatafile=None
+        usercache=0
+        orescache=0
 
-    if gen:
-        preloadingGen = pagegenerators.PreloadingGenerator(gen)
-        bot = PendingChangesRobot(preloadingGen, oresconfig, daylimit, formerbots)
+    if sitenames:
+        sites = [pywikibot.Site(code, family) for code, family in sitenames]
+    else:
+        sites = [pywikibot.Site()]
+
+    if len(sites) > 1 and not (stream or listgen):
+        pywikibot.error("-sites works only with -pendingchanges, -unreviewedpages and -stream")
+        return
+    if len(sites) > 1 and (stream == '-' or str(stream).startswith('tcp:')):
+        pywikibot.error("-sites needs a file or recent changes as the stream source")
+        return
+
+    generators = []
+    for site in sites:
+        if stream:
+            if stream is True:
+                changes = recentchangesStream(site)
+            else:
+                changes = jsonlinesStream(site, stream)
+            # Pages from the stream already have their flagged info
+            generators.append(streamGenerator(site, changes, debounce))
+            continue
+
+        if listgen:
+            gen = listgen(listlimit, site)
+        elif gen==None:
+            # This factory is responsible for processing command line
+            # arguments that are also used by other scripts and that
+            # determine on which pages to work on.
+            from pywikibot import pagegenerators
+            genFactory = pagegenerators.GeneratorFactory()
+            for arg in genargs:
+                genFactory.handleArg(arg)
+            gen = genFactory.getCombinedGenerator()
+
+        if gen:
+            # Listing, flagged info prefetch and evaluation run as
+            # overlapping stages. Page texts are not preloaded because
+            # only the revisions which need content tests are fetched.
+            if readahead:
+                gen = readaheadGenerator(gen, readahead)
+            flaggedGen = flaggedinfoGenerator(gen, site)
+            if readahead:
+                flaggedGen = readaheadGenerator(flaggedGen, readahead)
+            generators.append(flaggedGen)
+
+    if len(generators) > 1:
+        # Pages of all the wikis share the worker pool
+        flaggedGen = mergedGenerator(generators, max(readahead, 1))
+    elif generators:
+        flaggedGen = generators[0]
+    else:
+        flaggedGen = None
+
+    if flaggedGen:
+        bot = PendingChangesRobot(flaggedGen, oresconfig, daylimit, formerbots, toollabs, workers,
+                                  textcachesize, patrolwindow, usercache, statefile,
+                                  recheckhours, reviewrate, maxlag, statsfile, promfile,
+                                  profilefile, window, corpusfile, metadatafile, serverdiff, orescache,
+                                  savestate)
         bot.run()
     else:
         pywikibot.showHelp('pendingchanges')